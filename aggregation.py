@@ -0,0 +1,129 @@
+# Aggregation of crash counts from Super Search facet buckets, used by the
+# by-type and category scripts. Per-version buckets are loaded into columnar
+# arrays over days, versions and sub-facet terms, so scaling by throttle
+# factors and summing up over versions is done for all days of a product
+# and channel at once instead of looping through nested dicts.
+
+from __future__ import print_function  # to make print available in py3
+
+import numpy
+
+class CrashCounts(object):
+    # Columns are (sub-facet, term) pairs, e.g. ('process_type', 'content').
+    def __init__(self, days, versions, columns):
+        self.days = list(days)
+        self.versions = list(versions)
+        self.columns = list(columns)
+        shape = (len(self.days), len(self.versions))
+        # overall crash count of every version on every day
+        self.totals = numpy.zeros(shape, dtype=numpy.int64)
+        # whether a version had a bucket on that day at all
+        self.present = numpy.zeros(shape, dtype=bool)
+        # crash counts of every sub-facet term and whether it had a bucket
+        self.counts = numpy.zeros(shape + (len(self.columns),), dtype=numpy.int64)
+        self.seen = numpy.zeros(shape + (len(self.columns),), dtype=bool)
+
+    # Get arrays over days and versions of weights (e.g. throttle factors) and
+    # whether to include a version on a day at all, from a function returning
+    # the weight for a day index and version, or None to exclude it.
+    # Only versions present on a day are asked for.
+    def getWeights(self, weightfunc):
+        weights = []
+        include = numpy.zeros(self.present.shape, dtype=bool)
+        for (dayidx, present) in enumerate(self.present):
+            dayweights = []
+            for (veridx, version) in enumerate(self.versions):
+                weight = weightfunc(dayidx, version) if present[veridx] else None
+                include[dayidx, veridx] = weight is not None
+                dayweights.append(weight if weight is not None else 0)
+            weights.append(dayweights)
+        return (numpy.array(weights).reshape(self.present.shape), include)
+
+    # Sum up the weighted counts of all columns over the included versions.
+    # Returns arrays over days and columns of the sums and of whether any
+    # included version had a bucket for that term.
+    def sumColumns(self, weights, include):
+        sums = numpy.einsum('dv,dvc->dc', weights * include, self.counts)
+        seen = (self.seen & include[:, :, numpy.newaxis]).any(axis=1)
+        return (sums, seen)
+
+    # Sum up the weighted overall counts over the included versions per day.
+    def sumTotals(self, weights, include):
+        return numpy.einsum('dv,dv->d', weights * include, self.totals)
+
+    # Sum up the weighted part of the overall counts not covered by any term
+    # of a sub-facet over the included versions per day, e.g. the crashes
+    # without a process type being the ones of the browser process.
+    def sumRemainder(self, subfacet, weights, include):
+        colmask = numpy.array([column[0] == subfacet for column in self.columns], dtype=bool)
+        remainder = self.totals - self.counts[:, :, colmask].sum(axis=2)
+        return numpy.einsum('dv,dv->d', weights * include, remainder)
+
+# Load the version facet buckets of Super Search results for one day (which
+# can be a generator while the response is streamed in) with the given
+# sub-facets into columnar crash counts. A sub-facet can also be
+# '_cardinality.<field>' for the number of distinct values of a field in
+# every version bucket (e.g. of install times, i.e. installations), which
+# gets loaded as the column ('_cardinality.<field>', None).
+def loadVersionBuckets(vbuckets, subfacets, day = None):
+    versions = []
+    totals = []
+    columns = []
+    colindex = {}
+    cells = []
+    for vdata in vbuckets:
+        for subfacet in subfacets:
+            if subfacet.startswith('_cardinality.'):
+                cardinality = vdata['facets'].get('cardinality_' + subfacet[len('_cardinality.'):])
+                sbuckets = [{'term': None, 'count': cardinality['value']}] if cardinality else []
+            else:
+                sbuckets = vdata['facets'][subfacet]
+            for sdata in sbuckets:
+                column = (subfacet, sdata['term'])
+                if column not in colindex:
+                    colindex[column] = len(columns)
+                    columns.append(column)
+                cells.append((len(versions), colindex[column], sdata['count']))
+        versions.append(vdata['term'])
+        totals.append(vdata['count'])
+    table = CrashCounts([day], versions, columns)
+    if versions:
+        table.totals[0] = totals
+        table.present[0] = True
+    if cells:
+        (rows, cols, counts) = zip(*cells)
+        table.counts[0, rows, cols] = counts
+        table.seen[0, rows, cols] = True
+    return table
+
+# Stack crash counts of single days (or ranges of days) into one table over
+# all their days, versions and columns, e.g. to aggregate a whole backlog.
+def stackDays(tables):
+    versions = []
+    verindex = {}
+    columns = []
+    colindex = {}
+    for table in tables:
+        for version in table.versions:
+            if version not in verindex:
+                verindex[version] = len(versions)
+                versions.append(version)
+        for column in table.columns:
+            if column not in colindex:
+                colindex[column] = len(columns)
+                columns.append(column)
+    stacked = CrashCounts([day for table in tables for day in table.days], versions, columns)
+    offset = 0
+    for table in tables:
+        days = slice(offset, offset + len(table.days))
+        offset += len(table.days)
+        if not table.versions:
+            continue
+        vermap = numpy.array([verindex[version] for version in table.versions], dtype=numpy.intp)
+        stacked.totals[days, vermap] = table.totals
+        stacked.present[days, vermap] = table.present
+        if table.columns:
+            colmap = numpy.array([colindex[column] for column in table.columns], dtype=numpy.intp)
+            stacked.counts[days, vermap[:, numpy.newaxis], colmap] = table.counts
+            stacked.seen[days, vermap[:, numpy.newaxis], colmap] = table.seen
+    return stacked
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Benchmark the collectors end to end against a local fake Socorro API (see
+# fakesocorro.py), so throughput can be compared between changes without
+# network access. Every scenario runs the collector stages in a temporary
+# data path and reports wall time, request counts and stage timings.
+# The fake server runs in its own process so it doesn't compete with the
+# collectors for the interpreter lock.
+#
+# Usage: benchmark.py [--verbose] [--output=results.json] [scenario ...]
+
+from __future__ import print_function  # to make print available in py3
+
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+import datautils
+import fakesocorro
+from datautils import (global_defaults, createRunContext, runCollectors,
+                       finishRun, resetRunStats)
+
+# *** benchmark variables ***
+
+# collector scripts every scenario runs unless it lists its own 'stages'
+default_stages = ['get-dailydata', 'get-bytypedata', 'get-categorydata']
+
+# Scenarios to run, by default all of them. Besides 'name' they can set
+# 'backlog_days', 'args' for the collectors, 'stages', 'runs' (more than one
+# run reuses the data path, i.e. measures cached and unchanged re-runs) and
+# any fake server setting from fakesocorro.default_config.
+scenarios = [
+    {'name': 'small', 'backlog_days': 3, 'versions': 4},
+    {'name': 'default', 'backlog_days': 15, 'versions': 12},
+    {'name': 'long-backlog', 'backlog_days': 60, 'versions': 12},
+    {'name': 'many-versions', 'backlog_days': 15, 'versions': 40, 'release_cycle': 3},
+    {'name': 'slow-api', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.05, 'latency_jitter': 0.1},
+    {'name': 'flaky-api', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.02, 'error_rate': 0.05},
+    {'name': 'rate-limited', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.02, 'rate_limit': 30.0},
+    {'name': 'slow-api-batched', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.05, 'latency_jitter': 0.1, 'args': ['--batch-days']},
+    {'name': 'slow-api-combined', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.05, 'latency_jitter': 0.1, 'args': ['--combine-categories']},
+    {'name': 'slow-api-classified', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.05, 'latency_jitter': 0.1, 'args': ['--classify-signatures']},
+    {'name': 'slow-api-sharded', 'backlog_days': 15, 'versions': 12,
+     'latency': 0.05, 'latency_jitter': 0.1, 'args': ['--shard-daily']},
+    {'name': 'explosive', 'backlog_days': 20, 'versions': 12,
+     'stages': ['get-explosivedata'], 'runs': 2},
+    {'name': 'rerun', 'backlog_days': 15, 'versions': 12, 'runs': 2},
+]
+
+# settings overriding global_defaults while benchmarking
+benchmark_defaults = {
+    # don't spend the benchmark waiting for retries of failed requests
+    'api_retry_backoff': 0.1,
+    # measure the collectors, not our own rate limit
+    'api_rate_limit': None,
+}
+
+# Start a fake Socorro server process with the settings of a scenario.
+# Returns the process and the API URL it serves.
+def startServer(scenario):
+    import subprocess
+    command = [sys.executable, os.path.abspath(fakesocorro.__file__.replace('.pyc', '.py')), '--port=0']
+    for name in fakesocorro.default_config:
+        if name in scenario:
+            command.append('--' + name.replace('_', '-') + '=' + str(scenario[name]))
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = server.stdout.readline().decode('utf-8').strip()
+    if not line.startswith('Fake Socorro API running at '):
+        server.kill()
+        raise RuntimeError('Fake Socorro server failed to start')
+    return (server, line.split(' ')[-1])
+
+def getServerStats(api_url):
+    import json
+    import urllib2
+    return json.load(urllib2.urlopen(api_url + '_stats/'))
+
+def runScenario(scenario, verbose = False):
+    (server, api_url) = startServer(scenario)
+    datapath = tempfile.mkdtemp(prefix='magdalena-benchmark-')
+    olddefaults = dict(global_defaults)
+    global_defaults.update(benchmark_defaults)
+    datautils.API_URL = api_url
+    datautils.DATA_PATH = datapath
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    reports = []
+    try:
+        for runidx in range(scenario.get('runs', 1)):
+            resetRunStats()
+            startstats = getServerStats(api_url)
+            if not verbose:
+                sys.stdout = open(os.devnull, 'w')
+            try:
+                ctx = createRunContext(scenario.get('args', []), scenario.get('backlog_days', 15))
+                runCollectors(ctx, [(stage, importlib.import_module(stage).collect)
+                                    for stage in scenario.get('stages', default_stages)])
+                report = finishRun(ctx)
+            finally:
+                if sys.stdout is not stdout:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+            report['scenario'] = scenario['name']
+            report['run'] = runidx + 1
+            endstats = getServerStats(api_url)
+            report['server'] = dict([(name, endstats[name] - startstats[name]) for name in endstats])
+            reports.append(report)
+    finally:
+        server.terminate()
+        server.wait()
+        os.chdir(cwd)
+        shutil.rmtree(datapath, ignore_errors=True)
+        global_defaults.clear()
+        global_defaults.update(olddefaults)
+        datautils.DATA_PATH = None
+    return reports
+
+def printReport(report):
+    requests = report['server']['requests']
+    print('%-20s run %d: %7.2fs wall, %6d requests (%d failed, %d throttled), %7.1f requests/s, %d cache hits' %
+          (report['scenario'], report['run'], report['walltime'], requests,
+           report['server']['errors'], report['server']['throttled'],
+           requests / report['walltime'], report['api_cache']['hits']))
+    for (stage, times) in sorted(report['timings'].get('stage', {}).items()):
+        print('    %-20s %7.2fs' % (stage, times['total']))
+    for (api, stats) in sorted(report['api'].items()):
+        print('    %-20s %6d requests, %.3fs p50, %.3fs p95, %d bytes' %
+              (api, stats['requests'], stats['p50'], stats['p95'], stats['bytes']))
+
+# Run the actual meat of the script.
+def run(*args):
+    import json
+    verbose = '--verbose' in args
+    output = None
+    names = []
+    for arg in args:
+        if arg.startswith('--output='):
+            output = arg[len('--output='):]
+        elif not arg.startswith('--'):
+            names.append(arg)
+    unknown = set(names) - set([scenario['name'] for scenario in scenarios])
+    if unknown:
+        print('ERROR: Unknown scenario(s): ' + ', '.join(sorted(unknown)))
+        return 1
+
+    results = []
+    for scenario in scenarios:
+        if names and scenario['name'] not in names:
+            continue
+        for report in runScenario(scenario, verbose):
+            printReport(report)
+            results.append(report)
+    if output:
+        with open(output, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+        print('Results written to ' + output)
+
+
+# Avoid running the script when e.g. simply importing the file.
+if __name__ == '__main__':
+    sys.exit(run(*sys.argv[1:]))
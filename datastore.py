@@ -0,0 +1,336 @@
+# Storage for the collected data, used by multiple other scripts.
+# Data is kept in an SQLite database in the data path, where single days
+# (or other entries) can be updated without rewriting everything, and the
+# JSON files Datil consumes are exported from it whenever a dataset changed.
+
+from __future__ import print_function  # to make print available in py3
+
+import os
+import json
+import shutil
+import sqlite3
+from contextlib import contextmanager
+
+from datautils import global_defaults, timed
+
+# file name of the database in the data path
+DB_FILE = 'magdalena.sqlite'
+
+# Write a file in a crash-safe way: Everything is written to a temporary file,
+# which is synced to disk and then renamed over the old file, so readers
+# always see either the old or the new complete file. The old content is
+# kept as a '.bak' snapshot unless backup is False.
+@contextmanager
+def atomicWrite(fname, mode = 'w', backup = True):
+    tmpname = fname + '.tmp'
+    try:
+        with open(tmpname, mode) as outfile:
+            yield outfile
+            outfile.flush()
+            os.fsync(outfile.fileno())
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    if backup and os.path.exists(fname):
+        if os.path.exists(fname + '.bak'):
+            os.remove(fname + '.bak')
+        try:
+            # A hard link keeps the old content without copying it.
+            os.link(fname, fname + '.bak')
+        except OSError:
+            shutil.copy2(fname, fname + '.bak')
+    os.rename(tmpname, fname)
+    # Make sure the rename itself is on disk as well.
+    dirfd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+# Load a JSON file, falling back to its last good '.bak' snapshot if the file
+# is broken (e.g. truncated). Returns None if there's no valid data at all.
+def loadJSON(fname):
+    for candidate in [fname, fname + '.bak']:
+        try:
+            with open(candidate, 'r') as infile:
+                data = json.load(infile)
+        except IOError:
+            continue
+        except ValueError:
+            print('ERROR: ' + candidate + ' is not valid JSON!')
+            continue
+        if candidate != fname:
+            print('WARNING: ' + fname + ' is missing or broken, using last good snapshot.')
+        return data
+    return None
+
+# Get the names of the variant files configured to be written for a dataset.
+def getVariantFiles(dataset):
+    variants = global_defaults['export_variants']
+    fnames = [dataset + '.json']
+    if 'columns' in variants:
+        fnames.append(dataset + '.columns.json')
+    vnames = [fname for fname in fnames[1:]]
+    for fname in fnames:
+        if 'gzip' in variants:
+            vnames.append(fname + '.gz')
+        if 'brotli' in variants and getBrotli():
+            vnames.append(fname + '.br')
+    return vnames
+
+def getBrotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+# Write a gzip compressed copy of a file next to it. The file name and time
+# are left out of the gzip header so the same content gives the same file.
+def writeGzip(fname):
+    import gzip
+    with open(fname, 'rb') as infile, atomicWrite(fname + '.gz', 'wb', backup=False) as outfile:
+        gzfile = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=outfile, mtime=0)
+        try:
+            shutil.copyfileobj(infile, gzfile)
+        finally:
+            gzfile.close()
+
+# Write a brotli compressed copy of a file next to it.
+def writeBrotli(fname):
+    brotli = getBrotli()
+    with open(fname, 'rb') as infile:
+        data = infile.read()
+    with atomicWrite(fname + '.br', 'wb', backup=False) as outfile:
+        outfile.write(brotli.compress(data))
+
+# Get (path, value) pairs of all values in a (nested) dict, where the path is
+# a tuple of the keys leading to the value.
+def getValuePaths(data, path = ()):
+    if not isinstance(data, dict):
+        return [(path, data)]
+    paths = []
+    for key in sorted(data.keys()):
+        paths.extend(getValuePaths(data[key], path + (key,)))
+    return paths
+
+class DataStore(object):
+    def __init__(self, dbfile = DB_FILE):
+        self.db = sqlite3.connect(dbfile, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'dataset TEXT, key TEXT, subkey TEXT, value TEXT, '
+                        'PRIMARY KEY (dataset, key, subkey))')
+        # For every dataset, count changes and remember up to which change
+        # count the JSON file has been exported.
+        self.db.execute('CREATE TABLE IF NOT EXISTS datasets ('
+                        'dataset TEXT PRIMARY KEY, nested INTEGER, '
+                        'changes INTEGER, exported INTEGER, exported_size INTEGER)')
+        # Fingerprints of the overall data stored entries were fetched for,
+        # so we can tell if they need to be fetched again.
+        self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                        'dataset TEXT, key TEXT, fingerprint TEXT, '
+                        'PRIMARY KEY (dataset, key))')
+        # Databases created before we tracked the size of exported files.
+        columns = [column[1] for column in self.db.execute('PRAGMA table_info(datasets)')]
+        if 'exported_size' not in columns:
+            self.db.execute('ALTER TABLE datasets ADD COLUMN exported_size INTEGER')
+
+    # Make sure a dataset exists. If it's not known yet, import its existing
+    # JSON file (if any) so that we continue with the data we had so far.
+    # Nested datasets have two levels of keys (e.g. version and day).
+    def openDataset(self, dataset, nested = False):
+        if self.db.execute('SELECT 1 FROM datasets WHERE dataset = ?', (dataset,)).fetchone():
+            return
+        entries = []
+        with timed('io', 'json load'):
+            data = loadJSON(dataset + '.json')
+        if data is not None:
+            print('Import stored ' + dataset + ' data')
+            for (key, value) in data.items():
+                if nested:
+                    for (subkey, subvalue) in value.items():
+                        entries.append((dataset, key, subkey, json.dumps(subvalue, sort_keys=True)))
+                else:
+                    entries.append((dataset, key, '', json.dumps(value, sort_keys=True)))
+        self.db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', entries)
+        # Mark as changed so the file gets written out in a known good state.
+        self.db.execute('INSERT INTO datasets VALUES (?, ?, 1, 0, NULL)', (dataset, int(nested)))
+        self.db.commit()
+
+    # Get a dict of the values stored for the given keys of a dataset.
+    # Keys that have no value stored are not included.
+    def getEntries(self, dataset, keys, subkey = ''):
+        values = {}
+        for key in keys:
+            row = self.db.execute('SELECT value FROM entries WHERE dataset = ? AND key = ? AND subkey = ?',
+                                  (dataset, key, subkey)).fetchone()
+            if row:
+                values[key] = json.loads(row[0])
+        return values
+
+    # Get all keys a dataset has values for, sorted.
+    def getKeys(self, dataset):
+        return [row[0] for row in self.db.execute(
+            'SELECT DISTINCT key FROM entries WHERE dataset = ? ORDER BY key', (dataset,))]
+
+    # Get the entries of a nested dataset with subkeys in a range (e.g. of
+    # days) as a dict of keys to dicts of subkeys to values.
+    def getSubkeyRange(self, dataset, first, last):
+        values = {}
+        for (key, subkey, value) in self.db.execute(
+                'SELECT key, subkey, value FROM entries WHERE dataset = ? AND subkey >= ? AND subkey <= ?',
+                (dataset, first, last)):
+            values.setdefault(key, {})[subkey] = json.loads(value)
+        return values
+
+    # Delete the entries of a nested dataset with a subkey, e.g. of a day that
+    # gets replaced as a whole. Returns True if that actually changed anything.
+    def deleteSubkey(self, dataset, subkey):
+        return self.deleteWhere(dataset, 'subkey = ?', subkey)
+
+    # Delete the entries of a nested dataset with subkeys before the given one,
+    # e.g. days that dropped out of a time window.
+    # Returns True if that actually changed anything.
+    def pruneSubkeys(self, dataset, before):
+        return self.deleteWhere(dataset, 'subkey < ?', before)
+
+    # Delete the entries of a dataset with keys before the given one.
+    # Returns True if that actually changed anything.
+    def pruneKeys(self, dataset, before):
+        return self.deleteWhere(dataset, 'key < ?', before)
+
+    # Delete the entries of a dataset matching an SQL condition on a value.
+    def deleteWhere(self, dataset, condition, value):
+        deleted = self.db.execute('DELETE FROM entries WHERE dataset = ? AND ' + condition,
+                                  (dataset, value)).rowcount
+        if deleted:
+            self.db.execute('UPDATE datasets SET changes = changes + 1 WHERE dataset = ?', (dataset,))
+        return deleted > 0
+
+    # Store a value for a key (and subkey for nested datasets) of a dataset.
+    # Returns True if that actually changed anything.
+    def put(self, dataset, key, value, subkey = ''):
+        value = json.dumps(value, sort_keys=True)
+        row = self.db.execute('SELECT value FROM entries WHERE dataset = ? AND key = ? AND subkey = ?',
+                              (dataset, key, subkey)).fetchone()
+        if row and row[0] == value:
+            return False
+        self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                        (dataset, key, subkey, value))
+        self.db.execute('UPDATE datasets SET changes = changes + 1 WHERE dataset = ?', (dataset,))
+        return True
+
+    # Get the fingerprint stored for a key of a dataset, None if there's none.
+    def getFingerprint(self, dataset, key):
+        row = self.db.execute('SELECT fingerprint FROM fingerprints WHERE dataset = ? AND key = ?',
+                              (dataset, key)).fetchone()
+        return row[0] if row else None
+
+    # Store a fingerprint for a key of a dataset. Fingerprints are not
+    # exported and don't count as a change of the dataset.
+    def putFingerprint(self, dataset, key, fingerprint):
+        self.db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)',
+                        (dataset, key, fingerprint))
+
+    def commit(self):
+        self.db.commit()
+
+    # Write the JSON file of a dataset, sorted by keys, if it changed since
+    # the last export or the file is missing or has been modified (e.g.
+    # truncated) since. Returns True if it was written.
+    # The variants of the file (see exportVariants) get written along with it.
+    def exportJSON(self, dataset):
+        (nested, changes, exported, exported_size) = self.db.execute(
+            'SELECT nested, changes, exported, exported_size FROM datasets WHERE dataset = ?',
+            (dataset,)).fetchone()
+        fname = dataset + '.json'
+        if (changes == exported and os.path.exists(fname) and
+            os.path.getsize(fname) == exported_size):
+            # Variants may have been enabled or deleted since.
+            if not all([os.path.exists(vname) for vname in getVariantFiles(dataset)]):
+                self.exportVariants(dataset, nested)
+            return False
+
+        # Write entries one by one so we never need the whole dataset in memory.
+        with timed('io', 'json export'), atomicWrite(fname) as outfile:
+            outfile.write('{')
+            lastkey = None
+            for (key, subkey, value) in self.db.execute(
+                    'SELECT key, subkey, value FROM entries WHERE dataset = ? ORDER BY key, subkey',
+                    (dataset,)):
+                if nested:
+                    if key != lastkey:
+                        outfile.write(('}, ' if lastkey is not None else '') + json.dumps(key) + ': {')
+                    else:
+                        outfile.write(', ')
+                    outfile.write(json.dumps(subkey) + ': ' + value)
+                else:
+                    outfile.write((', ' if lastkey is not None else '') + json.dumps(key) + ': ' + value)
+                lastkey = key
+            outfile.write('}}' if nested and lastkey is not None else '}')
+        self.db.execute('UPDATE datasets SET exported = ?, exported_size = ? WHERE dataset = ?',
+                        (changes, os.path.getsize(fname), dataset))
+        self.db.commit()
+        self.exportVariants(dataset, nested)
+        return True
+
+    # Write the variants of the JSON file of a dataset configured in the
+    # export_variants default: a compact columnar one and gzip and brotli
+    # compressed copies of both, for lower transfer sizes when serving them.
+    def exportVariants(self, dataset, nested):
+        variants = global_defaults['export_variants']
+        fnames = [dataset + '.json']
+        with timed('io', 'json variants export'):
+            if 'columns' in variants:
+                with atomicWrite(dataset + '.columns.json', backup=False) as outfile:
+                    json.dump(self.getColumns(dataset, nested), outfile,
+                              separators=(',', ':'), sort_keys=True)
+                fnames.append(dataset + '.columns.json')
+            for fname in fnames:
+                if 'gzip' in variants:
+                    writeGzip(fname)
+                if 'brotli' in variants and getBrotli():
+                    writeBrotli(fname)
+
+    # Get the entries of a dataset as columns, i.e. parallel arrays: 'key'
+    # (and 'subkey' for nested datasets) has the keys of all entries, and
+    # every value in the entries has a column with its 'path' in the entry
+    # and the 'values' of all entries (null where an entry doesn't have it).
+    # Keys of nested datasets and lists of strings in values (e.g. versions)
+    # are given as indexes into a 'strings' list to not repeat them.
+    def getColumns(self, dataset, nested):
+        result = {'key': [], 'columns': []}
+        if nested:
+            result['subkey'] = []
+        strings = {}
+        def getStringIndex(string):
+            if string not in strings:
+                strings[string] = len(strings)
+            return strings[string]
+        columns = {}
+        rows = 0
+        for (key, subkey, value) in self.db.execute(
+                'SELECT key, subkey, value FROM entries WHERE dataset = ? ORDER BY key, subkey',
+                (dataset,)):
+            if nested:
+                result['key'].append(getStringIndex(key))
+                result['subkey'].append(getStringIndex(subkey))
+            else:
+                result['key'].append(key)
+            for (path, fieldvalue) in getValuePaths(json.loads(value)):
+                if isinstance(fieldvalue, list) and all([isinstance(item, type(u'')) for item in fieldvalue]):
+                    fieldvalue = [getStringIndex(item) for item in fieldvalue]
+                if path not in columns:
+                    columns[path] = {'path': list(path), 'values': [None] * rows}
+                    result['columns'].append(columns[path])
+                columns[path]['values'].append(fieldvalue)
+            rows += 1
+            for column in columns.values():
+                if len(column['values']) < rows:
+                    column['values'].append(None)
+        result['strings'] = sorted(strings.keys(), key=lambda string: strings[string])
+        return result
+
+    def close(self):
+        self.db.close()
@@ -1,46 +1,267 @@
 # Variables and utility functions used by multiple other scripts.
 
+from __future__ import print_function  # to make print available in py3
+
+import bisect
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from email.utils import parsedate_tz, mktime_tz
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 API_URL = 'https://crash-stats.mozilla.com/api/'
+# data path to use instead of looking for one of the known locations
+DATA_PATH = None
 global_defaults = {
     'backlog_days': 7,
     'explosive_backlog_days': 20,
     'socorrodata_backlog_days': 15,
+    # (connect, read) timeouts in seconds for API requests
+    'api_timeout': (10, 120),
+    # how often to retry failed API requests (5xx, 429, connection errors)
+    'api_retries': 4,
+    # backoff factor for retries, waits are factor * (2 ^ (retry - 1)) seconds
+    'api_retry_backoff': 2,
+    # maximum seconds to pause when the API asks us to with a Retry-After header
+    'api_max_retry_after': 300,
+    # maximum API requests per second per host, None for no limit
+    'api_rate_limit': 10,
+    # number of requests that can be sent at once before the rate limit kicks in
+    'api_rate_burst': 10,
+    # seconds of request latency above which we send fewer requests at once
+    'api_latency_target': 20,
+    # maximum number of pooled connections kept alive to the API host
+    'api_pool_size': 10,
+    # channels whose crash data is queried by a window of build IDs instead of
+    # by versions with --buildid-window, crashes on them must not be throttled
+    'buildid_window_channels': ['nightly', 'aurora'],
+    # number of worker threads fetching planned API queries concurrently
+    'api_workers': 8,
+    # maximum number of requests running at the same time against one host,
+    # fewer are sent while the host is slow or throttles us
+    'api_host_concurrency': 6,
+    # directory in the data path to cache API responses in, None to disable
+    'api_cache_dir': 'apicache',
+    # days after which Socorro doesn't reprocess crashes any more, cached
+    # results only covering days older than that never expire
+    'api_cache_immutable_days': 7,
+    # cache time in seconds for results covering today or yesterday
+    'api_cache_recent_ttl': 3600,
+    # cache time in seconds for everything else (e.g. version lists)
+    'api_cache_default_ttl': 6 * 3600,
+    # maximum size of the cache in bytes, least recently used entries get evicted
+    'api_cache_max_size': 500 * 1024 * 1024,
+    # decode large facets incrementally while downloading them where the
+    # collectors support that (needs the ijson module)
+    'api_stream_facets': True,
+    # also collect the number of installations affected by crashes (distinct
+    # install times) in the same queries the by-type and category data comes from
+    'collect_installs': False,
+    # maximum number of signatures get-categorydata gets with --classify-signatures,
+    # days with more fall back to a query filtered by the category signatures
+    'classify_facets_size': 10000,
+    # directory in the data path to write a JSON report for every run to, None to disable
+    'run_report_dir': 'runreports',
+    # days after which run reports get deleted, None to keep them forever
+    'run_report_max_age_days': 14,
+    # variants to write next to every exported JSON file: 'columns' for a
+    # compact columnar one, 'gzip' and 'brotli' (needs the brotli module)
+    # for compressed copies of the files, e.g. ['columns', 'gzip', 'brotli']
+    'export_variants': [],
+    # directory in the data path to keep checkpoints of backfills in
+    'backfill_dir': 'backfill',
+    # number of days to backfill at once before saving progress
+    'backfill_chunk_days': 7,
+    # seconds to pause between backfill chunks so we don't overload Socorro
+    'backfill_chunk_pause': 30,
+    # number of worker threads fetching API queries during a backfill
+    'backfill_workers': 2,
+    # maximum API requests per second during a backfill
+    'backfill_rate_limit': 2,
+    # seconds between the cycles of a daemon run with --daemon
+    'daemon_interval': 900,
+    # number of most recent days (including today) every daemon cycle refreshes
+    'daemon_recent_days': 2,
+    # number of older days of the backlog every daemon cycle fills in if missing
+    'daemon_fill_days': 2,
+    # seconds after which a daemon fetches the platform and version lists again
+    'daemon_versions_refresh': 6 * 3600,
 }
 
+# Shared HTTP session for all API requests, created on first use.
+api_session = None
+# Per-endpoint statistics of API requests done in this process.
+api_stats = {}
+# Lock for the shared session and statistics, API requests can run in threads.
+api_lock = threading.Lock()
+# Limiters of requests per host, see APILimiter.
+api_host_limiters = {}
+# Statistics of the API response cache.
+api_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+# Timings of this run, category -> name -> list of durations in seconds.
+run_timings = {}
+
+# Days as 'YYYY-MM-DD' strings get parsed into date objects only once, and
+# date objects formatted only once, as the collectors do date arithmetic on
+# the same few days over and over.
+day_format = '%Y-%m-%d'
+day_regex = re.compile(r"\d+-\d+-\d+")
+day_search_regex = re.compile(r"\d{4}-\d{2}-\d{2}")
+parsed_days = {}
+formatted_days = {}
+
 def getMaxBuildAge(channel, version_overall = False):
-    import datetime
     if channel == 'release':
-        return datetime.timedelta(weeks=12)
+        return timedelta(weeks=12)
     elif channel == 'beta':
-        return datetime.timedelta(weeks=4)
+        return timedelta(weeks=4)
     elif channel == 'aurora':
         if version_overall:
-            return datetime.timedelta(weeks=9)
+            return timedelta(weeks=9)
         else:
-            return datetime.timedelta(weeks=2)
+            return timedelta(weeks=2)
     elif channel == 'nightly':
         if version_overall:
-            return datetime.timedelta(weeks=9)
+            return timedelta(weeks=9)
         else:
-            return datetime.timedelta(weeks=1)
+            return timedelta(weeks=1)
     else:
-        return datetime.timedelta(days=365); # almost forever
+        return timedelta(days=365); # almost forever
+
+# Index of product versions, grouped by product and channel and sorted by
+# start date, so the versions active on a day can be looked up quickly.
+class VersionIndex(object):
+    def __init__(self, versions):
+        self.channels = {}
+        self.verinfo = {}
+        for ver in versions:
+            key = (ver['product'], ver['build_type'])
+            if key not in self.channels:
+                self.channels[key] = []
+            self.channels[key].append((ver['start_date'], ver['version']))
+            self.verinfo[(ver['product'], ver['version'])] = {'tfactor': 100 / ver['throttle']}
+        self.startdates = {}
+        for (key, verlist) in self.channels.items():
+            verlist.sort()
+            self.startdates[key] = [startdate for (startdate, version) in verlist]
+
+    # Get the versions of a product on a channel with a start date after
+    # min_startdate (and before max_startdate, if given) and a dict of info
+    # (e.g. 'tfactor') for each of them.
+    def getVersions(self, product, channel, min_startdate = '', max_startdate = None):
+        key = (product, channel)
+        if key not in self.channels:
+            return ([], {})
+        pos = bisect.bisect_right(self.startdates[key], min_startdate)
+        end = len(self.startdates[key])
+        if max_startdate is not None:
+            end = bisect.bisect_left(self.startdates[key], max_startdate)
+        versions = [version for (startdate, version) in self.channels[key][pos:end]]
+        return (versions, dict([(version, self.verinfo[(product, version)]) for version in versions]))
+
+    # Get the versions of a product on a channel that were active on anaday,
+    # i.e. not older than the given maximum build age.
+    def getActiveVersions(self, product, channel, anaday, max_build_age):
+        return self.getVersions(product, channel, dayStringBeforeDelta(anaday, max_build_age))
+
+    # Get all versions of a product on any channel, see getVersions.
+    def getProductVersions(self, product):
+        versions = []
+        verinfo = {}
+        for (prod, channel) in self.channels.keys():
+            if prod == product:
+                (chversions, chverinfo) = self.getVersions(product, channel)
+                versions.extend(chversions)
+                verinfo.update(chverinfo)
+        return (versions, verinfo)
+
+    # Get the versions of a product on any channel that were active on any
+    # day from firstday to lastday, see getActiveVersions.
+    def getProductVersionsInRange(self, product, firstday, lastday):
+        versions = []
+        verinfo = {}
+        for (prod, channel) in self.channels.keys():
+            if prod == product:
+                (chversions, chverinfo) = self.getVersions(
+                    product, channel, dayStringBeforeDelta(firstday, getMaxBuildAge(channel, True)),
+                    dayStringAdd(lastday, days=1))
+                versions.extend(chversions)
+                verinfo.update(chverinfo)
+        return (versions, verinfo)
+
+# Check if the crash data of a channel is to be queried by a window of build
+# IDs instead of by the versions active on a day (see getBuildIDParams).
+def useBuildIDWindow(ctx, channel):
+    return '--buildid-window' in ctx['args'] and channel in global_defaults['buildid_window_channels']
+
+# Get the name of the crash dataset of a kind (e.g. 'bytype') for a product
+# and channel. Data queried by build ID window counts crashes of different
+# builds than data queried by versions, so it goes into datasets of its own
+# and the two never get mixed in the same series.
+def getCrashDataset(ctx, product, channel, kind):
+    return (product + '-' + channel + '-crashes-' + kind +
+            ('-buildid' if useBuildIDWindow(ctx, channel) else ''))
+
+# Get the Super Search parameters selecting the crashes of a channel from
+# builds that are still considered active on a day, so no version list is
+# needed for the query. The versions come from its version facet then.
+def getBuildIDParams(channel, anaday):
+    min_buildid = dayStringBeforeDelta(anaday, getMaxBuildAge(channel)).replace('-', '') + '000000'
+    return {'release_channel': channel, 'build_id': '>=' + min_buildid}
+
+# Get the version info (see VersionIndex) for versions of a build ID window,
+# which we only know from the results. Crashes on the channels that are
+# queried that way are not throttled, so every version has a factor of 1.
+def getBuildIDVerinfo():
+    return defaultdict(lambda: {'tfactor': 1})
+
+# Get a VersionIndex of all versions of the given products possibly needed for
+# analyzing the days in anadayList.
+def getVersionIndex(products, anadayList):
+    # Get a minimum start date older than any needed for those days:
+    # 1) First element in the anadayList is the earlist day we build stuff for.
+    # 2) For unknown channels, getMaxBuildAge returns a larger age value than for anything else.
+    earliest_mindate = dayStringBeforeDelta(anadayList[0], getMaxBuildAge('none'))
+    return VersionIndex(getFromAPI('ProductVersions', {
+        'product': products,
+        'start_date': '>' + earliest_mindate,
+        'is_rapid_beta': 'false',
+    })['hits'])
 
 def dayList(backlog_days, forced_dates = None):
-    from datetime import datetime, timedelta
-    import re
     forced_dates = forced_dates or []
     days_to_analyze = [];
     for daysback in xrange(backlog_days):
         days_to_analyze.append(beforeTodayString(days=daysback))
     for anaday in forced_dates:
-        if re.match(r"\d+-\d+-\d+", anaday) and anaday not in days_to_analyze:
+        if day_regex.match(anaday) and anaday not in days_to_analyze:
             days_to_analyze.append(anaday)
     days_to_analyze.sort()
     return days_to_analyze
 
 def getDataPath():
-    import os
+    if DATA_PATH is not None:
+        return DATA_PATH
     data_path = None
     for testpath in ['/mnt/crashanalysis/rkaiser/',
                      '/home/rkaiser/reports/',
@@ -50,34 +271,941 @@ def getDataPath():
             break
     return data_path
 
-def getFromAPI(api, params = None):
-    import urllib
-    import requests
+# Set up what the collectors of one run share: command line arguments, days
+# to analyze, the data store, platform and version lists (fetched on first
+# use), the by-type data collected in this run and the fingerprints of the
+# (product, channel, day) units checked or fetched in this run.
+# With --daemon, runCollectors keeps running on the context, see runDaemon.
+def createRunContext(args, backlog_days):
+    from datastore import DataStore
+    forced_dates = verifyForcedDates(args)
+    datapath = getDataPath()
+    if datapath is None:
+        print('ERROR: No data path found, aborting!')
+        sys.exit(1)
+    os.chdir(datapath);
+    backfill = None
+    for arg in args:
+        if arg.startswith('--backfill='):
+            backfill = getBackfill(arg[len('--backfill='):])
+            if backfill is None:
+                print('ERROR: Backfill range needs to be given as --backfill=YYYY-MM-DD:YYYY-MM-DD, aborting!')
+                sys.exit(1)
+    if backfill and '--daemon' in args:
+        print('ERROR: A backfill can not be run as a daemon, aborting!')
+        sys.exit(1)
+    return {
+        'name': os.path.splitext(os.path.basename(sys.argv[0]))[0],
+        'starttime': time.time(),
+        'args': args,
+        'forced_dates': forced_dates,
+        'backlog_days': backlog_days,
+        'anadayList': dayList(backlog_days, forced_dates),
+        'backfill': backfill,
+        'daemon': '--daemon' in args,
+        'store': DataStore(),
+        'platforms': None,
+        'verindexes': {},
+        'bytype': {},
+        'fingerprints': {},
+    }
+
+# Run the collect functions of one or more collectors, given as a list of
+# (name, function) pairs, as stages on a run context. In backfill mode, they
+# run chunk by chunk over the backfill range with fewer concurrent requests,
+# saving progress after every chunk and pausing between chunks.
+def runCollectors(ctx, collectors):
+    if ctx['daemon']:
+        return runDaemon(ctx, collectors)
+    if not ctx['backfill']:
+        chunks = [None]
+    else:
+        days = ctx['backfill']['days']
+        chunksize = global_defaults['backfill_chunk_days']
+        chunks = [days[pos:pos + chunksize] for pos in xrange(0, len(days), chunksize)]
+        olddefaults = dict(global_defaults)
+        global_defaults['api_workers'] = global_defaults['backfill_workers']
+        global_defaults['api_rate_limit'] = global_defaults['backfill_rate_limit']
+    try:
+        for (chunkidx, chunk) in enumerate(chunks):
+            if chunk:
+                print('*** Backfill chunk ' + str(chunkidx + 1) + '/' + str(len(chunks)) +
+                      ': ' + chunk[0] + ' to ' + chunk[-1])
+                ctx['anadayList'] = chunk
+                ctx['forced_dates'] = chunk
+            runStages(ctx, collectors)
+            if chunk:
+                ctx['backfill']['checkpoint'].save()
+                if chunkidx + 1 < len(chunks):
+                    time.sleep(global_defaults['backfill_chunk_pause'])
+    finally:
+        if ctx['backfill']:
+            global_defaults.update(olddefaults)
+    if ctx['backfill']:
+        print('Backfill of ' + ctx['backfill']['days'][0] + ' to ' + ctx['backfill']['days'][-1] +
+              ' finished, progress is recorded in ' + ctx['backfill']['checkpoint'].fname)
+
+def runStages(ctx, collectors):
+    for (name, collect) in collectors:
+        if len(collectors) > 1:
+            print('*** Running ' + name)
+        with timed('stage', name):
+            collect(ctx)
+
+# Keep running the collectors in cycles until interrupted, with --daemon.
+# The run context stays warm between cycles, so the data store, the HTTP
+# connections and the platform and version lists get reused. Every cycle
+# refreshes the most recent days, whose data is still changing, and fills in
+# the next few of the older days of the backlog if they are missing, going
+# through the whole backlog a bit at a time. As always, only files whose data
+# changed get written, and every cycle writes its own run report.
+def runDaemon(ctx, collectors):
+    olddefaults = dict(global_defaults)
+    # Cached results for recent days must expire before the next cycle.
+    global_defaults['api_cache_recent_ttl'] = min(global_defaults['api_cache_recent_ttl'],
+                                                  global_defaults['daemon_interval'] // 2)
+    recentcount = global_defaults['daemon_recent_days']
+    fillcount = global_defaults['daemon_fill_days']
+    fillpos = 0
+    versionstime = time.time()
+    try:
+        while True:
+            resetRunStats()
+            ctx['starttime'] = time.time()
+            if ctx['starttime'] - versionstime > global_defaults['daemon_versions_refresh']:
+                ctx['platforms'] = None
+                ctx['verindexes'] = {}
+                versionstime = ctx['starttime']
+            # The days to analyze move along as days pass.
+            days = dayList(ctx['backlog_days'])
+            (olderdays, recentdays) = (days[:-recentcount], days[-recentcount:])
+            if fillpos >= len(olderdays):
+                fillpos = 0
+            filldays = olderdays[fillpos:fillpos + fillcount]
+            fillpos += fillcount
+            ctx['anadayList'] = filldays + recentdays
+            ctx['forced_dates'] = recentdays
+            # By-type data and fingerprints are only valid within a cycle.
+            ctx['bytype'] = {}
+            ctx['fingerprints'] = {}
+            print('*** Daemon cycle refreshing ' + ', '.join(recentdays) +
+                  (', filling in ' + ', '.join(filldays) if filldays else ''))
+            try:
+                runStages(ctx, collectors)
+            except Exception:
+                # A failed cycle shouldn't stop the daemon, the next one tries again.
+                traceback.print_exc()
+                print('ERROR: Daemon cycle failed!')
+            ctx['store'].commit()
+            reportRun(ctx)
+            time.sleep(max(0, ctx['starttime'] + global_defaults['daemon_interval'] - time.time()))
+    except KeyboardInterrupt:
+        print('Daemon stopped')
+    finally:
+        global_defaults.update(olddefaults)
+
+# Get the days and checkpoint of a backfill from a FROM:TO range of days,
+# None if that's not a valid range.
+def getBackfill(daterange):
+    days = verifyForcedDates(daterange.split(':'))
+    if len(days) != 2 or days[0] > days[1]:
+        return None
+    backfill = {'days': [], 'checkpoint': None}
+    anaday = days[0]
+    while anaday <= days[1]:
+        backfill['days'].append(anaday)
+        anaday = dayStringAdd(anaday, days=1)
+    backfill['checkpoint'] = BackfillCheckpoint(
+        os.path.join(global_defaults['backfill_dir'], days[0] + '_' + days[1] + '.json'))
+    return backfill
+
+# Record of the (dataset, day) pairs a backfill has completed, kept in a
+# checkpoint file in the data path so an interrupted backfill can resume.
+class BackfillCheckpoint(object):
+    def __init__(self, fname):
+        from datastore import loadJSON
+        self.fname = fname
+        self.done = {}
+        data = loadJSON(fname)
+        if data is not None:
+            print('Resuming backfill from ' + fname)
+            for (dataset, days) in data['done'].items():
+                self.done[dataset] = set(days)
+
+    def isDone(self, dataset, anaday):
+        return anaday in self.done.get(dataset, ())
+
+    def markDone(self, dataset, anaday):
+        self.done.setdefault(dataset, set()).add(anaday)
+
+    def save(self):
+        from datastore import atomicWrite
+        if not os.path.isdir(os.path.dirname(self.fname)):
+            os.makedirs(os.path.dirname(self.fname))
+        with atomicWrite(self.fname) as outfile:
+            json.dump({'done': dict([(dataset, sorted(days)) for (dataset, days) in self.done.items()])},
+                      outfile, sort_keys=True)
+
+# Check if a running backfill already completed the data of a day.
+def isBackfillDone(ctx, dataset, anaday):
+    return ctx['backfill'] is not None and ctx['backfill']['checkpoint'].isDone(dataset, anaday)
+
+# Record that the data of a day is complete, if we are running a backfill.
+def markBackfillDone(ctx, dataset, anaday):
+    if ctx['backfill'] is not None:
+        ctx['backfill']['checkpoint'].markDone(dataset, anaday)
+
+def getRunPlatforms(ctx):
+    if ctx['platforms'] is None:
+        results = getFromAPI('Platforms')
+        ctx['platforms'] = []
+        for plt in results:
+            ctx['platforms'].append(plt["name"])
+    return ctx['platforms']
+
+# Get the VersionIndex of products for the days of the run, fetched only
+# once unless the days to analyze (e.g. of a daemon cycle) start earlier
+# than the ones it was fetched for.
+def getRunVersionIndex(ctx, products):
+    key = tuple(sorted(products))
+    if key not in ctx['verindexes'] or ctx['verindexes'][key][0] > ctx['anadayList'][0]:
+        ctx['verindexes'][key] = (ctx['anadayList'][0], getVersionIndex(list(key), ctx['anadayList']))
+    return ctx['verindexes'][key][1]
+
+# Finish a run: close the store, clean up and report. Returns the run report.
+def finishRun(ctx):
+    ctx['store'].close()
+    return reportRun(ctx)
+
+# Clean up after a run (or daemon cycle) and report on it.
+# Returns the run report.
+def reportRun(ctx):
+    pruneAPICache()
+    printAPIStats()
+    report = getRunReport(ctx)
+    writeRunReport(report, ctx['starttime'])
+    return report
+
+# Forget the statistics and timings gathered so far, e.g. before the next of
+# multiple runs in one process.
+def resetRunStats():
+    with api_lock:
+        api_stats.clear()
+        run_timings.clear()
+        for name in api_cache_stats:
+            api_cache_stats[name] = 0
+
+def recordTiming(category, name, seconds):
+    with api_lock:
+        if category not in run_timings:
+            run_timings[category] = {}
+        if name not in run_timings[category]:
+            run_timings[category][name] = []
+        run_timings[category][name].append(seconds)
+
+# Context manager recording the time spent in its block, e.g.
+# with timed('stage', 'get-bytypedata'):
+@contextmanager
+def timed(category, name):
+    starttime = time.time()
+    try:
+        yield
+    finally:
+        recordTiming(category, name, time.time() - starttime)
+
+# Get the given percentile (0-100) of a list of values (nearest rank).
+def getPercentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percentile / 100.0 * len(values))) - 1)]
+
+def summarizeTimes(times):
+    return {
+        'count': len(times),
+        'total': sum(times),
+        'p50': getPercentile(times, 50),
+        'p95': getPercentile(times, 95),
+        'max': max(times) if times else None,
+    }
+
+# Get a machine-readable report of this run, with request counts, latencies
+# and transferred bytes per API endpoint, API cache statistics and all
+# recorded timings.
+def getRunReport(ctx):
+    endtime = time.time()
+    report = {
+        'name': ctx['name'],
+        'args': list(ctx['args']),
+        'start': datetime.utcfromtimestamp(ctx['starttime']).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'end': datetime.utcfromtimestamp(endtime).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'walltime': endtime - ctx['starttime'],
+        'api': {},
+        'api_cache': dict(api_cache_stats),
+        'timings': {},
+    }
+    for (api, stats) in api_stats.items():
+        report['api'][api] = summarizeTimes(stats['times'])
+        report['api'][api].update({
+            'requests': stats['requests'],
+            'errors': stats['errors'],
+            'throttled': stats['throttled'],
+            'bytes': stats['bytes'],
+            'parsetime': stats['parsetime'],
+        })
+    for (category, names) in run_timings.items():
+        report['timings'][category] = {}
+        for (name, times) in names.items():
+            report['timings'][category][name] = summarizeTimes(times)
+    return report
+
+# Write a run report into the run report directory.
+def writeRunReport(report, starttime):
+    if global_defaults['run_report_dir'] is None:
+        return
+    if not os.path.isdir(global_defaults['run_report_dir']):
+        os.makedirs(global_defaults['run_report_dir'])
+    fname = os.path.join(global_defaults['run_report_dir'],
+                         datetime.utcfromtimestamp(starttime).strftime('%Y%m%d-%H%M%S') +
+                         '-' + report['name'] + '.json')
+    with open(fname, 'w') as outfile:
+        json.dump(report, outfile, indent=2, sort_keys=True)
+    print('Run report written to ' + fname)
+    pruneRunReports()
+
+# Delete run reports older than the maximum age, e.g. so the ones of every
+# cycle of a daemon don't pile up.
+def pruneRunReports():
+    if global_defaults['run_report_max_age_days'] is None:
+        return
+    mintime = time.time() - global_defaults['run_report_max_age_days'] * 86400
+    for filename in os.listdir(global_defaults['run_report_dir']):
+        fname = os.path.join(global_defaults['run_report_dir'], filename)
+        if filename.endswith('.json') and os.path.getmtime(fname) < mintime:
+            os.remove(fname)
+
+def getAPISession():
+    global api_session
+    with api_lock:
+        if api_session is None:
+            retry = Retry(total=global_defaults['api_retries'],
+                          backoff_factor=global_defaults['api_retry_backoff'],
+                          # 429 and 503 are handled by getFromAPI and the APILimiter.
+                          status_forcelist=[500, 502, 504],
+                          respect_retry_after_header=False,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=global_defaults['api_pool_size'],
+                                  max_retries=retry)
+            api_session = requests.Session()
+            api_session.mount('https://', adapter)
+            api_session.mount('http://', adapter)
+    return api_session
+
+# Limiter of the requests to one API host, shared by all threads: A token
+# bucket caps the request rate, and the number of requests running at once
+# is adjusted AIMD-style, growing slowly while responses come in fast and
+# halving when they get slow or the host pushes back with 429 or 503, which
+# also pauses all requests for as long as the host asks (Retry-After).
+class APILimiter(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tokens = float(global_defaults['api_rate_burst'])
+        self.lastfill = time.time()
+        self.concurrency = float(global_defaults['api_host_concurrency'])
+        self.active = 0
+        self.paused_until = 0
+        self.lastdecrease = 0
+
+    # Wait until we may send a request.
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                rate = global_defaults['api_rate_limit']
+                if rate:
+                    self.tokens = min(float(global_defaults['api_rate_burst']),
+                                      self.tokens + (now - self.lastfill) * rate)
+                self.lastfill = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.active >= int(self.concurrency):
+                    wait = 1.0 # woken up by release() anyhow
+                elif rate and self.tokens < 1:
+                    wait = (1 - self.tokens) / rate
+                else:
+                    if rate:
+                        self.tokens -= 1
+                    self.active += 1
+                    return
+                self.cond.wait(wait)
+
+    # Report a finished request, how long it took and if it was throttled,
+    # optionally with the seconds the host asked us to pause.
+    def release(self, latency, throttled = False, pause = None):
+        with self.cond:
+            self.active -= 1
+            now = time.time()
+            maxconcurrency = float(global_defaults['api_host_concurrency'])
+            if throttled or latency > global_defaults['api_latency_target']:
+                # Requests sent together tend to come back together, only
+                # decrease once for them.
+                if now - self.lastdecrease > latency:
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.lastdecrease = now
+            else:
+                self.concurrency = min(maxconcurrency, self.concurrency + 1.0 / self.concurrency)
+            if pause:
+                self.paused_until = max(self.paused_until, now + pause)
+            self.cond.notify_all()
+
+def getHostLimiter(url):
+    host = urlparse.urlparse(url).netloc
+    with api_lock:
+        if host not in api_host_limiters:
+            api_host_limiters[host] = APILimiter()
+    return api_host_limiters[host]
+
+# Get the seconds to pause after a throttled response: what its Retry-After
+# header says (in seconds or as a date), or an exponential backoff.
+def getRetryPause(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    pause = None
+    if retry_after:
+        if retry_after.strip().isdigit():
+            pause = int(retry_after)
+        elif parsedate_tz(retry_after):
+            pause = mktime_tz(parsedate_tz(retry_after)) - time.time()
+    if pause is None:
+        pause = global_defaults['api_retry_backoff'] * (2 ** attempt)
+    return max(0, min(pause, global_defaults['api_max_retry_after']))
+
+# Get the file caching results for an API query, None if caching is disabled.
+# The file name is a hash of the endpoint and the normalized parameters.
+def getAPICacheFile(api, params):
+    datapath = getDataPath()
+    if global_defaults['api_cache_dir'] is None or datapath is None:
+        return None
+    normparams = {}
+    for (name, value) in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            normparams[name] = sorted([str(item) for item in value])
+        else:
+            normparams[name] = str(value)
+    key = hashlib.sha1(API_URL + api + '?' + json.dumps(normparams, sort_keys=True)).hexdigest()
+    return os.path.join(datapath, global_defaults['api_cache_dir'], key[:2], key + '.json')
+
+# Get the time in seconds results of an API query fetched now can be cached
+# for, or None if they never expire as they only cover days Socorro doesn't
+# change any more.
+def getAPICacheTTL(params):
+    newest_day = None
+    open_ended = False
+    has_upper = False
+    for value in (params or {}).values():
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            item = str(item)
+            found = day_search_regex.search(item)
+            if not found:
+                continue
+            if item.startswith('>'):
+                open_ended = True
+            elif item.startswith('<'):
+                has_upper = True
+            if newest_day is None or found.group(0) > newest_day:
+                newest_day = found.group(0)
+    if newest_day is None or (open_ended and not has_upper):
+        return global_defaults['api_cache_default_ttl']
+    age = (datetime.utcnow().date() - parseDay(newest_day)).days
+    if age > global_defaults['api_cache_immutable_days']:
+        return None
+    elif age <= 1:
+        return global_defaults['api_cache_recent_ttl']
+    return global_defaults['api_cache_default_ttl']
+
+# Get the time results of an API query fetched now expire at, None if never.
+def getAPICacheExpiry(params):
+    ttl = getAPICacheTTL(params)
+    return time.time() + ttl if ttl is not None else None
+
+def readAPICache(cachefile, params):
+    try:
+        with open(cachefile, 'r') as infile:
+            cached = json.load(infile)
+    except (IOError, ValueError):
+        return None
+    # Whether results never expire depends on how old their days were when
+    # they got fetched, not now, as results fetched while a day was still
+    # changing stay incomplete. Entries from before we stored that expire.
+    if 'expires' not in cached:
+        return None
+    if cached['expires'] is not None:
+        # The current cache times apply as well, they may be shorter (e.g. for a daemon).
+        ttl = getAPICacheTTL(params)
+        if cached['expires'] < time.time() or (ttl is not None and cached['time'] + ttl < time.time()):
+            return None
+    # Mark as recently used for the LRU eviction in pruneAPICache.
+    try:
+        os.utime(cachefile, None)
+    except OSError:
+        pass
+    return cached['results']
+
+def writeAPICache(cachefile, api, params, results):
+    try:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+    except OSError:
+        pass # created by another thread in the meantime
+    tmpfile = cachefile + '.' + str(threading.current_thread().ident) + '.tmp'
+    try:
+        with open(tmpfile, 'w') as outfile:
+            json.dump({'api': api, 'params': params, 'time': time.time(),
+                       'expires': getAPICacheExpiry(params), 'results': results}, outfile)
+        os.rename(tmpfile, cachefile)
+    except (IOError, OSError) as e:
+        print('WARNING: could not write API cache file: ' + str(e))
+
+# Evict least recently used cache entries until the cache fits into its
+# maximum size again.
+def pruneAPICache():
+    datapath = getDataPath()
+    if global_defaults['api_cache_dir'] is None or datapath is None:
+        return
+    entries = []
+    totalsize = 0
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(datapath, global_defaults['api_cache_dir'])):
+        for filename in filenames:
+            fstat = os.stat(os.path.join(dirpath, filename))
+            entries.append((fstat.st_mtime, fstat.st_size, os.path.join(dirpath, filename)))
+            totalsize += fstat.st_size
+    entries.sort()
+    while entries and totalsize > global_defaults['api_cache_max_size']:
+        (mtime, size, cachefile) = entries.pop(0)
+        os.remove(cachefile)
+        totalsize -= size
+        api_cache_stats['evictions'] += 1
+
+def getAPIURL(api, params = None):
     url = API_URL + api + '/'
     if params:
         url += '?' + urllib.urlencode(params, True)
+    return url
+
+def recordAPIStats(api, reqtime, parsetime, nbytes, failed, throttled = 0):
+    with api_lock:
+        if api not in api_stats:
+            api_stats[api] = {'requests': 0, 'errors': 0, 'throttled': 0, 'bytes': 0, 'times': [], 'parsetime': 0.0}
+        stats = api_stats[api]
+        stats['requests'] += 1
+        stats['times'].append(reqtime)
+        stats['parsetime'] += parsetime
+        stats['bytes'] += nbytes
+        stats['throttled'] += throttled
+        if failed:
+            stats['errors'] += 1
+
+# Get cached results of an API query, None if there are none (or caching is disabled).
+def getCachedAPIResults(cachefile, params):
+    if not cachefile:
+        return None
+    results = readAPICache(cachefile, params)
+    with api_lock:
+        api_cache_stats['hits' if results is not None else 'misses'] += 1
+    return results
+
+def getFromAPI(api, params = None):
+    cachefile = getAPICacheFile(api, params)
+    results = getCachedAPIResults(cachefile, params)
+    if results is not None:
+        return results
+    url = getAPIURL(api, params)
     #print(url)
-    response = requests.get(url)
-    return response.json()
+    limiter = getHostLimiter(url)
+    # Throttled requests are retried here, after pausing as long as the host
+    # wants us to, other failures already get retried by the session.
+    # Waiting for the limiter doesn't count into the request time.
+    reqtime = 0.0
+    for attempt in xrange(global_defaults['api_retries'] + 1):
+        response = None
+        throttled = False
+        limiter.acquire()
+        starttime = time.time()
+        try:
+            try:
+                response = getAPISession().get(url, timeout=global_defaults['api_timeout'])
+            except requests.exceptions.RequestException as e:
+                results = {'error': 'API request to ' + api + ' failed: ' + str(e)}
+            throttled = response is not None and response.status_code in (429, 503)
+        finally:
+            reqtime += time.time() - starttime
+            limiter.release(time.time() - starttime, throttled,
+                            getRetryPause(response, attempt) if throttled else None)
+        if not throttled:
+            break
+    parsetime = 0.0
+    if throttled:
+        results = {'error': 'API request to ' + api + ' was throttled (HTTP status ' +
+                            str(response.status_code) + ')'}
+    elif response is not None:
+        parsestart = time.time()
+        try:
+            results = response.json()
+        except ValueError:
+            results = {'error': 'API response from ' + api + ' is not valid JSON (HTTP status ' +
+                                str(response.status_code) + ')'}
+        parsetime = time.time() - parsestart
+    recordAPIStats(api, reqtime, parsetime, len(response.content) if response is not None else 0,
+                   isinstance(results, dict) and 'error' in results, attempt + int(throttled))
+    # Error responses can come with JSON that doesn't say so.
+    if (cachefile and response is not None and response.status_code == 200 and
+        not (isinstance(results, dict) and 'error' in results)):
+        writeAPICache(cachefile, api, params, results)
+    return results
+
+# File-like wrapper around a streamed API response, counting the bytes read
+# and copying them into a cache file (if any) as they pass through, so the
+# cache gets the same entry getFromAPI would have written.
+class APIStreamReader(object):
+    def __init__(self, raw, cachefile, api, params):
+        self.raw = raw
+        self.bytes = 0
+        self.cachefile = cachefile
+        self.outfile = None
+        if cachefile:
+            self.tmpfile = cachefile + '.' + str(threading.current_thread().ident) + '.tmp'
+            try:
+                if not os.path.isdir(os.path.dirname(cachefile)):
+                    os.makedirs(os.path.dirname(cachefile))
+            except OSError:
+                pass # created by another thread in the meantime
+            try:
+                self.outfile = open(self.tmpfile, 'w')
+                self.outfile.write('{"api": ' + json.dumps(api) + ', "params": ' + json.dumps(params) +
+                                   ', "time": ' + json.dumps(time.time()) +
+                                   ', "expires": ' + json.dumps(getAPICacheExpiry(params)) + ', "results": ')
+            except IOError as e:
+                print('WARNING: could not write API cache file: ' + str(e))
+                self.outfile = None
+
+    def read(self, size = 64 * 1024):
+        data = self.raw.read(size)
+        self.bytes += len(data)
+        if self.outfile:
+            self.outfile.write(data)
+        return data
+
+    # Read the rest of the response and complete the cache file.
+    def finish(self):
+        while self.read():
+            pass
+        if self.outfile:
+            self.outfile.write('}')
+            self.outfile.close()
+            os.rename(self.tmpfile, self.cachefile)
 
+    def abort(self):
+        if self.outfile:
+            self.outfile.close()
+            os.remove(self.tmpfile)
+
+# Get the ijson module for incremental JSON decoding, None if it's not
+# available or streaming is disabled.
+def getStreamingParser():
+    if not global_defaults['api_stream_facets']:
+        return None
+    return ijson
+
+# Generate the buckets of a facet while decoding a streamed response with
+# ijson. Results without that facet (e.g. errors) raise a ValueError at the
+# end instead of looking like an empty facet.
+def iterFacetBuckets(ijson, reader, facet):
+    (facetprefix, itemprefix) = ('facets.' + facet, 'facets.' + facet + '.item')
+    (started, error) = (False, False)
+    events = ijson.parse(reader)
+    for (prefix, event, value) in events:
+        if prefix == '' and event == 'map_key' and value == 'error':
+            error = True
+        elif prefix == facetprefix and event == 'start_array':
+            started = True
+        elif prefix == itemprefix:
+            if event in ('start_map', 'start_array'):
+                builder = ijson.ObjectBuilder()
+                endevent = event.replace('start', 'end')
+                while (prefix, event) != (itemprefix, endevent):
+                    builder.event(event, value)
+                    (prefix, event, value) = next(events)
+                yield builder.value
+            else:
+                yield value
+    if error or not started:
+        raise ValueError('API results have no ' + facet + ' facet')
+
+# Fetch an API query and return what the given function makes out of its
+# results. If possible, the buckets of the given facet are decoded while the
+# response is still downloading and handed to the function as a generator in
+# results['facets'][facet], so the full response never needs to be held in
+# memory, but other parts of the results are not available then. Without
+# streaming, the function gets the normal results of getFromAPI.
+def processFromAPI(api, params, facet, process):
+    ijson = getStreamingParser()
+    if ijson is None or facet is None:
+        return process(getFromAPI(api, params))
+    cachefile = getAPICacheFile(api, params)
+    results = getCachedAPIResults(cachefile, params)
+    if results is not None:
+        return process(results)
+    url = getAPIURL(api, params)
+    limiter = getHostLimiter(url)
+    limiter.acquire()
+    starttime = time.time()
+    (throttled, pause) = (False, None)
+    try:
+        try:
+            response = getAPISession().get(url, timeout=global_defaults['api_timeout'], stream=True)
+        except requests.exceptions.RequestException:
+            response = None
+        if response is not None and response.status_code in (429, 503):
+            (throttled, pause) = (True, getRetryPause(response, 0))
+        if response is not None and response.status_code == 200:
+            response.raw.decode_content = True
+            reader = APIStreamReader(response.raw, cachefile, api, params)
+            try:
+                buckets = iterFacetBuckets(ijson, reader, facet)
+                processed = process({'facets': {facet: buckets}})
+                # Make sure the whole facet got checked even if not all of it was used.
+                for bucket in buckets:
+                    pass
+                reader.finish()
+            except Exception:
+                # Broken or incomplete response, try again the normal way below,
+                # where errors are handled and reported as usual.
+                reader.abort()
+                response.close()
+                response = None
+            else:
+                # Decoding overlaps with the download, so it's all request time.
+                recordAPIStats(api, time.time() - starttime, 0.0, reader.bytes, False)
+                return processed
+        elif response is not None:
+            response.close()
+            response = None
+    finally:
+        limiter.release(time.time() - starttime, throttled, pause)
+    return process(getFromAPI(api, params))
+
+# Fetch a list of planned queries concurrently. Every query is a dict with an
+# 'api' and an optional 'params' entry, results are returned in the same order.
+# A query can also have a 'process' function the results are run through
+# while still in the fetching thread, and name a 'stream' facet to hand that
+# function incrementally, see processFromAPI.
+# The time each query took is added to it as 'time'.
+def fetchAll(queries, workers = None):
+    if not queries:
+        return []
+    def fetchQuery(query):
+        starttime = time.time()
+        if 'process' in query:
+            results = processFromAPI(query['api'], query.get('params'),
+                                     query.get('stream'), query['process'])
+        else:
+            results = getFromAPI(query['api'], query.get('params'))
+        query['time'] = time.time() - starttime
+        return results
+    workers = min(workers or global_defaults['api_workers'], len(queries))
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(fetchQuery, queries, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+# Fetch the planned queries of a list of work units concurrently and attach
+# the results for each unit's 'queries' list to it as its 'results' list.
+def fetchUnits(units):
+    queries = []
+    for unit in units:
+        queries.extend(unit['queries'])
+    results = fetchAll(queries)
+    offset = 0
+    for unit in units:
+        unit['results'] = results[offset:offset + len(unit['queries'])]
+        offset += len(unit['queries'])
+    return units
+
+# Get a name for a (product, channel, day) unit for messages and timings.
+def getUnitName(unit):
+    return unit['product'] + ' ' + unit['channel'].capitalize() + ' ' + unit['anaday']
+
+# Record the time fetching the queries of a unit took, if it fetched them itself.
+def recordUnitFetchTiming(category, unit):
+    if unit['queries'] and all(['time' in query for query in unit['queries']]):
+        recordTiming(category, getUnitName(unit), sum([query['time'] for query in unit['queries']]))
+
+# Get the queries of a cheap check whether the overall data of a (product,
+# channel, day) unit changed: ADI and crash counts per version, without any
+# of the breakdowns the collectors fetch.
+def planCheckQueries(product, anaday, versions, platforms):
+    return [
+        {'api': 'ADI', 'params': {
+            'product': product,
+            'versions': versions,
+            'start_date': anaday,
+            'end_date': anaday,
+            'platforms': platforms,
+        }},
+        {'api': 'SuperSearch', 'params': {
+            'product': product,
+            'version': versions,
+            'date': ['>=' + anaday,
+                     '<' + dayStringAdd(anaday, days=1)],
+            '_facets': 'version',
+            '_results_number': 0,
+        }},
+    ]
+
+# Get a fingerprint of the overall data of a unit from its ADI results and a
+# dict of crash counts per version: a hash of the versions, their ADI and
+# crash counts. None if the ADI results are not valid.
+def getFingerprint(versions, adiresults, crashcounts):
+    if not 'hits' in adiresults:
+        return None
+    versions = sorted(versions)
+    adi = dict([(adidata['version'], adidata['adi_count']) for adidata in adiresults['hits']
+                if adidata['version'] in versions])
+    crashes = dict([(version, int(count)) for (version, count) in crashcounts.items()
+                    if version in versions])
+    return hashlib.sha1(json.dumps({'versions': versions, 'adi': adi, 'crashes': crashes},
+                                   sort_keys=True)).hexdigest()
+
+# Get the fingerprints of the overall data of units, see getFingerprint,
+# from the ones known in this run already or by fetching their check
+# queries. Units where that fails get None.
+def fetchFingerprints(ctx, units):
+    checks = []
+    for unit in units:
+        key = (unit['product'], unit['channel'], unit['anaday'])
+        if key not in ctx['fingerprints']:
+            checks.append({'key': key, 'versions': unit['versions'],
+                           'queries': planCheckQueries(unit['product'], unit['anaday'],
+                                                       unit['versions'], getRunPlatforms(ctx))})
+    fetchUnits(checks)
+    for check in checks:
+        (adiresults, ssresults) = check['results']
+        if not 'facets' in ssresults or not 'version' in ssresults['facets']:
+            continue
+        fingerprint = getFingerprint(check['versions'], adiresults,
+                                     dict([(vdata['term'], vdata['count'])
+                                           for vdata in ssresults['facets']['version']]))
+        if fingerprint:
+            ctx['fingerprints'][check['key']] = fingerprint
+    return [ctx['fingerprints'].get((unit['product'], unit['channel'], unit['anaday']))
+            for unit in units]
+
+# Remember the fingerprint of the overall data the stored data of a unit was
+# fetched for, and for later stages of this run.
+def setUnitFingerprint(ctx, unit, fingerprint):
+    if fingerprint:
+        ctx['fingerprints'][(unit['product'], unit['channel'], unit['anaday'])] = fingerprint
+        ctx['store'].putFingerprint(unit['dataset'], unit['anaday'], fingerprint)
+
+# Drop the planned units marked with 'check' (e.g. forced days we have data
+# for already) whose overall data still has the fingerprint stored for the
+# data we have, so only days where that changed get their expensive
+# breakdowns fetched again. All checked units get their current fingerprint
+# as 'fingerprint'. Returns the units that need to be fetched.
+def skipUnchangedUnits(ctx, units):
+    checkunits = [unit for unit in units if unit.get('check')]
+    if not checkunits:
+        return units
+    with timed('phase', 'change check'):
+        fingerprints = fetchFingerprints(ctx, checkunits)
+    for (unit, fingerprint) in zip(checkunits, fingerprints):
+        unit['fingerprint'] = fingerprint
+        if fingerprint and fingerprint == ctx['store'].getFingerprint(unit['dataset'], unit['anaday']):
+            print('Unchanged: ' + unit['dataset'] + ' on ' + unit['anaday'] + ', skipping')
+            unit['unchanged'] = True
+            markBackfillDone(ctx, unit['dataset'], unit['anaday'])
+    return [unit for unit in units if not unit.get('unchanged')]
+
+# Group planned units of the same product and channel into batches of
+# consecutive days.
+def batchUnits(units):
+    batches = []
+    for unit in sorted(units, key=lambda unit: (unit['product'], unit['channel'], unit['anaday'])):
+        last = batches[-1][-1] if batches else None
+        if (last and last['product'] == unit['product'] and last['channel'] == unit['channel'] and
+            dayStringAdd(last['anaday'], days=1) == unit['anaday']):
+            batches[-1].append(unit)
+        else:
+            batches.append([unit])
+    return batches
+
+# Split Super Search results with a daily date histogram over '<field>'
+# buckets into per-day results looking like those of a one-day query with
+# '_aggs.<field>'. dayterms maps each day to the terms to keep for that day.
+# Returns None if the results are not made up like that.
+def splitDailyHistogram(results, field, dayterms):
+    if not 'facets' in results or not 'histogram_date' in results['facets']:
+        return None
+    daybuckets = {}
+    for bucket in results['facets']['histogram_date']:
+        if not 'facets' in bucket or not field in bucket['facets']:
+            return None
+        for fdata in bucket['facets'][field]:
+            if not 'facets' in fdata:
+                return None
+        daybuckets[bucket['term'][:10]] = bucket['facets'][field]
+    dayresults = {}
+    for (anaday, terms) in dayterms.items():
+        dayresults[anaday] = {'facets': {field: [fdata for fdata in daybuckets.get(anaday, [])
+                                                 if fdata['term'] in terms]}}
+    return dayresults
+
+def printAPIStats():
+    for api in sorted(api_stats.keys()):
+        stats = api_stats[api]
+        print('API ' + api + ': ' + str(stats['requests']) + ' requests, ' +
+              str(stats['errors']) + ' errors, ' + str(stats['throttled']) + ' throttled, ' +
+              '%.2fs total, %.2fs p50, %.2fs p95, %.2fs max, %d bytes' %
+              (sum(stats['times']), getPercentile(stats['times'], 50),
+               getPercentile(stats['times'], 95), max(stats['times']), stats['bytes']))
+    if api_cache_stats['hits'] or api_cache_stats['misses']:
+        print('API cache: ' + str(api_cache_stats['hits']) + ' hits, ' +
+              str(api_cache_stats['misses']) + ' misses, ' +
+              str(api_cache_stats['evictions']) + ' evictions')
+
+# Get the valid days from a list of arguments. Well-formed but impossible
+# days like 2016-02-30 are left out as well.
 def verifyForcedDates(fdates):
-    from datetime import datetime
-    import re
     force_dates = [];
     for fdate in fdates:
-        if (re.match(r"\d+-\d+-\d+", fdate) and
-            datetime.strptime(fdate, '%Y-%m-%d').strftime('%Y-%m-%d') == fdate):
-            force_dates.append(fdate);
+        if not day_regex.match(fdate):
+            continue
+        try:
+            if formatDay(parseDay(fdate)) == fdate:
+                force_dates.append(fdate);
+        except ValueError:
+            pass
     return force_dates
 
+# Get the date object of a 'YYYY-MM-DD' day string.
+def parseDay(anaday):
+    if anaday not in parsed_days:
+        parsed_days[anaday] = datetime.strptime(anaday, day_format).date()
+    return parsed_days[anaday]
+
+# Get the 'YYYY-MM-DD' day string of a date object.
+def formatDay(day):
+    if day not in formatted_days:
+        formatted_days[day] = day.strftime(day_format)
+    return formatted_days[day]
+
 def beforeTodayString(days = 0, weeks = 0):
-    from datetime import datetime, timedelta
-    return (datetime.utcnow() - timedelta(days=days, weeks=weeks)).strftime('%Y-%m-%d')
+    return formatDay(datetime.utcnow().date() - timedelta(days=days, weeks=weeks))
 
 def dayStringAdd(anaday, days = 0, weeks = 0):
-    from datetime import datetime, timedelta
-    return (datetime.strptime(anaday, '%Y-%m-%d') + timedelta(days=days, weeks=weeks)).strftime('%Y-%m-%d')
+    return formatDay(parseDay(anaday) + timedelta(days=days, weeks=weeks))
 
 def dayStringBeforeDelta(anaday, tdelta):
-    from datetime import datetime
-    return (datetime.strptime(anaday, '%Y-%m-%d') - tdelta).strftime('%Y-%m-%d')
+    return formatDay(parseDay(anaday) - tdelta)
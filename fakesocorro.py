@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# A local stand-in for the Socorro API, serving synthetic but deterministic
+# Platforms, ProductVersions, ADI, SuperSearch and CrashesPerAdu responses,
+# so the collectors can be run and benchmarked without network access.
+# Latency and the rate of failing requests can be configured.
+
+from __future__ import print_function  # to make print available in py3
+
+# strptime imports this lazily, which isn't thread-safe in py2.
+import _strptime
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+# *** fake data variables ***
+
+# signatures crashes are spread over, covering all categories of get-categorydata
+signatures = [
+    'OOM | small', 'OOM | large | mozalloc_abort', 'OOM | unknown | js::Foo',
+    'OOM | large | NS_ABORT_OOM', 'js::AutoEnterOOMUnsafeRegion::crash',
+    'shutdownhang | WaitForSingleObject', 'IPCError-browser | ShutDownKill',
+    '@0x0', '@0x1234 | foo', '@0xdeadbeef', '@0x0 | @0x1', '@0x0 | libxul.so@0x1234',
+    'nvwgf2umx.dll@0x5678', 'mozilla::dom::Foo::Bar', 'js::GCMarker::processMarkStackTop',
+    'CrashReporter::Something', 'EMPTY: no crashing thread identified; ERROR_NO_MINIDUMP_HEADER',
+]
+# process types, None being the browser (main) process
+process_types = [None, 'content', 'plugin', 'gpu']
+products = ['Firefox', 'FennecAndroid']
+platforms = ['Windows', 'Mac OS X', 'Linux']
+# suffixes of version numbers on the different channels
+channel_suffixes = {'release': '', 'beta': 'b1', 'aurora': 'a2', 'nightly': 'a1'}
+
+# Configuration of a server, see startServer().
+default_config = {
+    # number of versions per product and channel, one new every release cycle
+    'versions': 12,
+    # days between two versions of the same channel
+    'release_cycle': 14,
+    # seconds every request takes before being answered
+    'latency': 0.0,
+    # random additional seconds every request can take on top of that
+    'latency_jitter': 0.0,
+    # share of requests failing with a 5xx error
+    'error_rate': 0.0,
+    # requests per second above which we answer with 429 and Retry-After, 0 for no limit
+    'rate_limit': 0.0,
+    # seed for the random decisions on latency and errors
+    'seed': 0,
+}
+
+def getDay(datestring):
+    return datetime.strptime(datestring[:10], '%Y-%m-%d').date()
+
+def getVersions(config):
+    versions = []
+    today = date.today()
+    for product in products:
+        for (chanidx, channel) in enumerate(sorted(channel_suffixes.keys())):
+            for idx in range(config['versions']):
+                startdate = today - timedelta(days=config['release_cycle'] * idx + chanidx)
+                versions.append({
+                    'product': product,
+                    'version': '%d.0%s' % (50 - idx + chanidx, channel_suffixes[channel]),
+                    'build_type': channel,
+                    'start_date': startdate.isoformat(),
+                    'end_date': (startdate + timedelta(days=100)).isoformat(),
+                    'throttle': 10 if (channel == 'release' and product == 'Firefox') else 100,
+                })
+    return versions
+
+# Get the (deterministic) crash groups of a product version on a day. Every
+# group stands for a number of crashes sharing all fields we can search for.
+def getCrashGroups(product, version, day):
+    rng = random.Random(zlib.crc32(('%s|%s|%s' % (product, version, day)).encode('utf-8')))
+    groups = []
+    for signature in signatures:
+        for process_type in process_types:
+            for uptime in (10, 1000):
+                count = rng.randint(1, 6) if rng.random() < 0.6 else 0
+                if count:
+                    groups.append({
+                        'signature': signature,
+                        'process_type': process_type,
+                        'plugin_hang': 'T' if (process_type == 'plugin' and uptime == 1000) else 'F',
+                        'uptime': uptime,
+                        'platform': platforms[rng.randint(0, len(platforms) - 1)],
+                        'version': version,
+                        'product': product,
+                        'date': day.isoformat() + 'T00:00:00+00:00',
+                        'count': count,
+                        'install_time': count // 2 + 1,
+                    })
+    return groups
+
+def getADI(version, day):
+    return zlib.crc32((version + day.isoformat()).encode('utf-8')) % 100000 + 1000
+
+# Get the (deterministic) build ID of the crashes of a group, from a day in
+# the release cycle of its version, which started at startdate.
+def getBuildID(config, startdate, group):
+    offset = zlib.crc32(('%s|%s|%s' % (group['signature'], group['process_type'], group['uptime'])).encode('utf-8'))
+    builddate = getDay(startdate) + timedelta(days=offset % config['release_cycle'])
+    return builddate.strftime('%Y%m%d') + '030000'
+
+# Check if a signature matches a SuperSearch filter value, supporting the
+# operators the collectors use (including negation with '!').
+def matchSignature(signature, filterval):
+    negate = filterval.startswith('!')
+    if negate:
+        filterval = filterval[1:]
+    if filterval.startswith('^'):
+        match = signature.startswith(filterval[1:])
+    elif filterval.startswith('$'):
+        match = signature.endswith(filterval[1:])
+    elif filterval.startswith('='):
+        match = signature == filterval[1:]
+    elif filterval.startswith('@'):
+        # Quoted parts of regular expressions are literals in Elasticsearch.
+        pattern = re.sub(r'"([^"]*)"', lambda m: re.escape(m.group(1)), filterval[1:])
+        match = re.match('^(?:' + pattern + ')$', signature) is not None
+    elif filterval.startswith('~'):
+        match = filterval[1:] in signature
+    else:
+        match = filterval in signature
+    return match != negate
+
+def searchCrashGroups(config, params):
+    mindate = maxdate = None
+    for value in params.get('date', []):
+        if value.startswith('>='):
+            mindate = getDay(value[2:])
+        elif value.startswith('<'):
+            maxdate = getDay(value[1:])
+    # Without versions, all versions of a release channel.
+    versions = params.get('version', [])
+    if not versions and 'release_channel' in params:
+        versions = [version['version'] for version in getVersions(config)
+                    if version['build_type'] in params['release_channel']]
+    min_buildid = ([value[2:] for value in params.get('build_id', []) if value.startswith('>=')] or [None])[0]
+    startdates = dict([((version['product'], version['version']), version['start_date'])
+                       for version in getVersions(config)])
+    positive = [value for value in params.get('signature', []) if not value.startswith('!')]
+    negative = [value for value in params.get('signature', []) if value.startswith('!')]
+    groups = []
+    day = mindate
+    while day < maxdate:
+        for product in params.get('product', []):
+            for version in versions:
+                for group in getCrashGroups(product, version, day):
+                    if min_buildid and getBuildID(config, startdates[(product, version)], group) < min_buildid:
+                        continue
+                    if positive and not any([matchSignature(group['signature'], value) for value in positive]):
+                        continue
+                    if not all([matchSignature(group['signature'], value) for value in negative]):
+                        continue
+                    if 'uptime' in params and not group['uptime'] < int(params['uptime'][0][1:]):
+                        continue
+                    groups.append(group)
+        day += timedelta(days=1)
+    return groups
+
+# Build SuperSearch facet buckets of a field, with optional sub-aggregations.
+def getFacet(groups, field, subfacets, size):
+    buckets = {}
+    for group in groups:
+        if group[field] is not None:
+            buckets.setdefault(group[field], []).append(group)
+    results = []
+    for (term, termgroups) in buckets.items():
+        bucket = {'term': term, 'count': sum([group['count'] for group in termgroups])}
+        if subfacets:
+            bucket['facets'] = {}
+            for subfacet in subfacets:
+                if subfacet.startswith('_cardinality.'):
+                    subfield = subfacet[len('_cardinality.'):]
+                    bucket['facets']['cardinality_' + subfield] = {
+                        'value': sum([group[subfield] for group in termgroups])}
+                else:
+                    bucket['facets'][subfacet] = getFacet(termgroups, subfacet, None, size)
+        results.append(bucket)
+    results.sort(key=lambda bucket: (-bucket['count'], str(bucket['term'])))
+    return results[:size]
+
+def getNestedFacet(groups, path, subfacets, size):
+    if len(path) == 1:
+        return getFacet(groups, path[0], subfacets, size)
+    results = getFacet(groups, path[0], None, size)
+    for bucket in results:
+        termgroups = [group for group in groups if group[path[0]] == bucket['term']]
+        bucket['facets'] = {path[1]: getNestedFacet(termgroups, path[1:], subfacets, size)}
+    return results
+
+def getSuperSearch(config, params):
+    groups = searchCrashGroups(config, params)
+    size = int(params.get('_facets_size', ['50'])[0])
+    results = {'total': sum([group['count'] for group in groups]), 'hits': [], 'facets': {}}
+    for field in params.get('_facets', ['signature']):
+        if field.startswith('_cardinality.'):
+            subfield = field[len('_cardinality.'):]
+            results['facets']['cardinality_' + subfield] = {
+                'value': sum([group[subfield] for group in groups])}
+        else:
+            results['facets'][field] = getFacet(groups, field, None, size)
+    for (name, values) in params.items():
+        if name.startswith('_aggs.'):
+            path = name[len('_aggs.'):].split('.')
+            results['facets'][path[0]] = getNestedFacet(groups, path, values, size)
+        elif name.startswith('_histogram.'):
+            path = name[len('_histogram.'):].split('.')
+            histogram = getNestedFacet(groups, path, values, 10000)
+            histogram.sort(key=lambda bucket: bucket['term'])
+            results['facets']['histogram_' + path[0]] = histogram
+    return results
+
+def getCrashesPerAdu(params):
+    product = params['product'][0]
+    hits = {}
+    for version in params.get('versions', []):
+        day = getDay(params['from_date'][0])
+        while day <= getDay(params['to_date'][0]):
+            hits.setdefault(product + ':' + version, {})[day.isoformat()] = {
+                'version': version,
+                'report_count': sum([group['count'] for group in getCrashGroups(product, version, day)]),
+                'adu': getADI(version, day) // 100,
+            }
+            day += timedelta(days=1)
+    return {'hits': hits}
+
+# Get the results of an API call, None if the API is unknown.
+def getAPIResults(config, api, params):
+    if api == 'Platforms':
+        return [{'name': name} for name in platforms]
+    elif api == 'ProductVersions':
+        hits = [version for version in getVersions(config)
+                if version['product'] in params.get('product', products) and
+                   ('start_date' not in params or version['start_date'] > params['start_date'][0][1:])]
+        return {'hits': hits, 'total': len(hits)}
+    elif api == 'ADI':
+        hits = []
+        day = getDay(params['start_date'][0])
+        while day <= getDay(params['end_date'][0]):
+            for version in params.get('versions', []):
+                hits.append({'version': version, 'date': day.isoformat(),
+                             'adi_count': getADI(version, day), 'build_type': 'release'})
+            day += timedelta(days=1)
+        return {'hits': hits, 'total': len(hits)}
+    elif api == 'SuperSearch':
+        return getSuperSearch(config, params)
+    elif api == 'CrashesPerAdu':
+        return getCrashesPerAdu(params)
+    return None
+
+def getRequestHandler():
+    import BaseHTTPServer
+    import urlparse
+
+    class FakeSocorroHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            server = self.server
+            url = urlparse.urlparse(self.path)
+            api = url.path.strip('/').split('/')[-1]
+            if api == '_stats':
+                # Not part of Socorro, lets benchmarks get our statistics.
+                with server.lock:
+                    return self.sendJSON(200, server.stats)
+            with server.lock:
+                server.stats['requests'] += 1
+                delay = server.config['latency'] + server.rng.random() * server.config['latency_jitter']
+                failing = server.rng.random() < server.config['error_rate']
+                throttled = False
+                if server.config['rate_limit']:
+                    # Token bucket allowing a burst of one second worth of requests.
+                    now = time.time()
+                    server.tokens = min(server.config['rate_limit'],
+                                        server.tokens + (now - server.lastfill) * server.config['rate_limit'])
+                    server.lastfill = now
+                    if server.tokens < 1:
+                        throttled = True
+                        server.stats['throttled'] += 1
+                    else:
+                        server.tokens -= 1
+            if throttled:
+                return self.sendJSON(429, {'detail': 'Request was throttled.'}, {'Retry-After': '1'})
+            if delay:
+                time.sleep(delay)
+            if failing:
+                with server.lock:
+                    server.stats['errors'] += 1
+                return self.sendJSON(503, {'error': 'Service temporarily unavailable'})
+            results = getAPIResults(server.config, api, urlparse.parse_qs(url.query))
+            if results is None:
+                return self.sendJSON(404, {'error': 'Unknown API ' + api})
+            self.sendJSON(200, results)
+
+        def sendJSON(self, status, data, headers = None):
+            body = json.dumps(data)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for (name, value) in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeSocorroHandler
+
+# Start a fake Socorro server on localhost in a background thread, on a free
+# port unless one is given. The API URL to use is in its 'api_url' attribute,
+# request statistics are in 'stats' (also served as the '_stats' API).
+# Stop it with its shutdown() method.
+def startServer(port = 0, **config):
+    import BaseHTTPServer
+    import SocketServer
+
+    class FakeSocorroServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = FakeSocorroServer(('127.0.0.1', port), getRequestHandler())
+    server.config = dict(default_config)
+    server.config.update(config)
+    server.rng = random.Random(server.config['seed'])
+    server.lock = threading.Lock()
+    server.stats = {'requests': 0, 'errors': 0, 'throttled': 0}
+    server.tokens = server.config['rate_limit']
+    server.lastfill = time.time()
+    server.api_url = 'http://127.0.0.1:%d/api/' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+# Run a server until interrupted, e.g. to point a collector at by hand.
+def run(*args):
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Serve a fake Socorro API on localhost.')
+    parser.add_argument('--port', type=int, default=8766, help='0 to use any free port')
+    for (name, value) in sorted(default_config.items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+    options = vars(parser.parse_args(args))
+    port = options.pop('port')
+    server = startServer(port, **options)
+    print('Fake Socorro API running at ' + server.api_url)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+# Avoid running the script when e.g. simply importing the file.
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
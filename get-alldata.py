@@ -0,0 +1,29 @@
+# Run all collectors in one process, sharing what they have in common
+
+from __future__ import print_function  # to make print available in py3
+
+import importlib
+
+from datautils import global_defaults, createRunContext, runCollectors, finishRun
+
+# *** data gathering variables ***
+
+# collector scripts to run as stages, in this order (categories need by-type data)
+stages = ['get-dailydata', 'get-bytypedata', 'get-categorydata', 'get-explosivedata']
+
+# for how many days back to get the data
+backlog_days = global_defaults['socorrodata_backlog_days']
+
+# Run the actual meat of the script.
+# All stages share the data store, the HTTP session and API cache, the
+# platform and version lists and the by-type data collected in this run.
+def run(*args):
+    ctx = createRunContext(args, backlog_days)
+    runCollectors(ctx, [(stage, importlib.import_module(stage).collect) for stage in stages])
+    finishRun(ctx)
+
+
+# Avoid running the script when e.g. simply importing the file.
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
@@ -4,14 +4,18 @@ from __future__ import print_function  # to make print available in py3
 from pprint import pprint  # pretty print python objects
 
 import datetime
-import os
-import json
-from collections import OrderedDict
+import functools
 import re
-
-from datautils import (getFromAPI, global_defaults, verifyForcedDates,
-                       getMaxBuildAge, getDataPath, dayList,
-                       dayStringBeforeDelta, dayStringAdd)
+from datautils import (fetchUnits, batchUnits, splitDailyHistogram,
+                       global_defaults, getMaxBuildAge, createRunContext,
+                       getRunPlatforms, getRunVersionIndex, runCollectors,
+                       finishRun, timed, isBackfillDone, markBackfillDone,
+                       recordUnitFetchTiming, getUnitName, dayStringAdd,
+                       getFingerprint, setUnitFingerprint, skipUnchangedUnits,
+                       useBuildIDWindow, getBuildIDParams, getBuildIDVerinfo,
+                       getCrashDataset)
+from aggregation import loadVersionBuckets, stackDays
+from rollups import updateRollups
 
 # *** data gathering variables ***
 
@@ -24,50 +28,285 @@ prodchannels = {
 # for how many days back to get the data
 backlog_days = global_defaults['socorrodata_backlog_days']
 
+# sub-facets of the versions facet the crash types come from
+type_subfacets = ['process_type', 'plugin_hang']
+
 # *** URLs and paths ***
 
-# Run the actual meat of the script.
-def run(*args):
-    forced_dates = verifyForcedDates(args)
-    anadayList = dayList(backlog_days, forced_dates)
+# Get the ADI and crash data queries for one product and day.
+def planDayQueries(product, anaday, versions, platforms):
+    return [
+        planADIQuery(product, anaday, versions, platforms),
+        planCrashQuery(product, anaday, {'version': versions}),
+    ]
+
+def planADIQuery(product, anaday, versions, platforms):
+    return {'api': 'ADI', 'params': {
+        'product': product,
+        'versions': versions,
+        'start_date': anaday,
+        'end_date': anaday,
+        'platforms': platforms,
+    }}
+
+# Get the crash data query for one product and day, for the crashes the
+# given Super Search parameters select, e.g. by versions or build IDs.
+def planCrashQuery(product, anaday, selector):
+    ssquery = {'api': 'SuperSearch', 'params': {
+        'product': product,
+        'date': ['>=' + anaday,
+                 '<' + dayStringAdd(anaday, days=1)],
+        '_aggs.version': list(type_subfacets),
+        '_results_number': 0,
+    }, 'stream': 'version', 'process': reduceCrashResults}
+    ssquery['params'].update(selector)
+    if global_defaults['collect_installs']:
+        # Installations per version, and per type and version the other way round,
+        # as the version buckets can't have both type sub-facets and their installations.
+        # Those other facets are not available while streaming the versions facet.
+        ssquery['params']['_aggs.version'].append('_cardinality.install_time')
+        for subfacet in type_subfacets:
+            ssquery['params']['_aggs.' + subfacet + '.version'] = ['_cardinality.install_time']
+        del ssquery['stream']
+    return ssquery
+
+# Get the ADI and crash data queries for one product and a range of
+# consecutive days, crash data is split up by a daily date histogram.
+def planBatchQueries(product, days, versions, platforms):
+    return [
+        {'api': 'ADI', 'params': {
+            'product': product,
+            'versions': versions,
+            'start_date': days[0],
+            'end_date': days[-1],
+            'platforms': platforms,
+        }},
+        {'api': 'SuperSearch', 'params': {
+            'product': product,
+            'version': versions,
+            'date': ['>=' + days[0],
+                     '<' + dayStringAdd(days[-1], days=1)],
+            '_histogram.date.version': list(type_subfacets),
+            '_histogram_interval.date': '1d',
+            '_results_number': 0,
+        }},
+    ]
+
+# Split the results of a batch into the per-day results of its units.
+# Returns False if they can't be split up by day.
+def splitBatchResults(batch):
+    (adiresults, ssresults) = batch['results']
+    if not 'hits' in adiresults:
+        return False
+    dayadi = {}
+    for adidata in adiresults['hits']:
+        if not 'date' in adidata:
+            return False
+        dayadi.setdefault(adidata['date'][:10], []).append(adidata)
+    dayresults = splitDailyHistogram(ssresults, 'version',
+                                     dict((unit['anaday'], unit['versions']) for unit in batch['units']))
+    if dayresults is None:
+        return False
+    for unit in batch['units']:
+        unit['results'] = [{'hits': dayadi.get(unit['anaday'], [])},
+                           reduceCrashResults(dayresults[unit['anaday']])]
+    return True
+
+# Fetch data for units whose crash data is queried by build ID window (see
+# getBuildIDParams): first their crash data, then the ADI of the versions
+# found in it. Their results are the same as with per-day queries then.
+def fetchBuildIDUnits(units, platforms):
+    fetchUnits(units)
+    adiunits = []
+    for unit in units:
+        ssresults = unit['results'][0]
+        unit['versions'] = sorted(ssresults['counts'].versions) if 'counts' in ssresults else []
+        unit['adi'] = {'queries': [planADIQuery(unit['product'], unit['anaday'], unit['versions'], platforms)]
+                                  if unit['versions'] else []}
+        adiunits.append(unit['adi'])
+    fetchUnits(adiunits)
+    for unit in units:
+        unit['results'] = [unit['adi']['results'][0] if unit['versions'] else {'hits': []},
+                           unit['results'][0]]
+
+# Fetch data for the planned units with one batch of queries per product,
+# channel and range of consecutive days, falling back to per-day queries
+# for batches where that fails.
+def fetchBatches(units, platforms):
+    batches = []
+    dayunits = []
+    for batchunits in batchUnits(units):
+        if len(batchunits) == 1:
+            dayunits.extend(batchunits)
+            continue
+        days = [unit['anaday'] for unit in batchunits]
+        versions = sorted(set([ver for unit in batchunits for ver in unit['versions']]))
+        batches.append({
+            'units': batchunits,
+            'queries': planBatchQueries(batchunits[0]['product'], days, versions, platforms),
+        })
+    fetchUnits(batches)
+    for batch in batches:
+        if not splitBatchResults(batch):
+            print('Batched fetching failed for ' + batch['units'][0]['product'] + ' ' +
+                  batch['units'][0]['channel'].capitalize() + ', falling back to per-day queries.')
+            dayunits.extend(batch['units'])
+    fetchUnits(dayunits)
+
+# Reduce the results of a crash data query to columnar per-version crash
+# counts, leaving results without a version facet (e.g. errors) as they are.
+# With installations, those are loaded as columns as well, see addTypeInstalls.
+def reduceCrashResults(results):
+    if not 'facets' in results or not 'version' in results['facets']:
+        return results
+    if global_defaults['collect_installs']:
+        addTypeInstalls(results)
+        return {'counts': loadVersionBuckets(results['facets']['version'], type_subfacets +
+                                             ['_cardinality.install_time'] +
+                                             [subfacet + '_installs' for subfacet in type_subfacets])}
+    return {'counts': loadVersionBuckets(results['facets']['version'], type_subfacets)}
+
+# Move the installations per type and version from the '<sub-facet>' facets
+# of '_aggs.<sub-facet>.version' into the version buckets, as
+# '<sub-facet>_installs' sub-facets with the installations as their count.
+def addTypeInstalls(results):
+    vbuckets = dict([(vdata['term'], vdata) for vdata in results['facets']['version']])
+    for subfacet in type_subfacets:
+        for vdata in vbuckets.values():
+            vdata['facets'][subfacet + '_installs'] = []
+        for tdata in results['facets'].get(subfacet, []):
+            for vdata in tdata['facets']['version']:
+                if vdata['term'] in vbuckets and 'cardinality_install_time' in vdata['facets']:
+                    vbuckets[vdata['term']]['facets'][subfacet + '_installs'].append(
+                        {'term': tdata['term'], 'count': vdata['facets']['cardinality_install_time']['value']})
+
+# Get the fingerprint of the overall data of a unit from its ADI and crash
+# data results, see getFingerprint.
+def getResultsFingerprint(unit):
+    (adiresults, ssresults) = unit['results']
+    if not 'counts' in ssresults:
+        return None
+    counts = ssresults['counts']
+    return getFingerprint(unit['versions'], adiresults,
+                          dict(zip(counts.versions, counts.totals[0].tolist())))
+
+# Get the name of the crash type a sub-facet term is counted as, None if it's
+# not counted as its own type.
+def getTypeName(subfacet, term):
+    if subfacet == 'plugin_hang':
+        return 'Hang Plugin' if term == 'T' else None
+    elif term == 'plugin':
+        return 'OOP Plugin'
+    return term.capitalize()
+
+# Assemble the by-type data of units of one product and channel from their
+# ADI and crash data results. Returns the data of every unit in the same
+# order, None for units where results are missing.
+def processResults(units):
+    bytypes = [None] * len(units)
+    dayadis = []
+    tables = []
+    for (idx, unit) in enumerate(units):
+        (adiresults, ssresults) = unit['results']
+        daydesc = getUnitName(unit)
+
+        # Get ADI data.
+        adi = {}
+        if not 'hits' in adiresults:
+            if 'error' in adiresults:
+                print('ERROR (' + daydesc + '): ' + adiresults['error'])
+            else:
+                print('ERROR (' + daydesc + '): could not fetch ADI correctly!')
+            continue
+        for adidata in adiresults['hits']:
+           adi[adidata['version']] = adidata['adi_count']
+
+        # Get crash data.
+        if not 'counts' in ssresults:
+            if 'error' in ssresults:
+                print('ERROR (' + daydesc + '): ' + ssresults['error'])
+            else:
+                print('ERROR (' + daydesc + '): no versions facet present!')
+            continue
+        dayadis.append((idx, adi))
+        tables.append(ssresults['counts'])
+    if not tables:
+        return bytypes
+
+    # only add the count for a version if the version has ADI.
+    def getWeight(dayidx, version):
+        (idx, adi) = dayadis[dayidx]
+        if version in units[idx]['versions'] and version in adi:
+            return units[idx]['verinfo'][version]['tfactor']
+        return None
+    counts = stackDays(tables)
+    (weights, include) = counts.getWeights(getWeight)
+    (sums, seen) = counts.sumColumns(weights, include)
+    browser = counts.sumRemainder('process_type', weights, include)
+    if global_defaults['collect_installs']:
+        # Distinct installations can't be scaled up from throttled samples
+        # like crash counts, so they are summed up unweighted.
+        (installsums, seen) = counts.sumColumns(include.astype(int), include)
 
-    datapath = getDataPath()
-    if datapath is None:
-        print('ERROR: No data path found, aborting!')
-        import sys
-        sys.exit(1)
-    os.chdir(datapath);
+    for (dayidx, (idx, adi)) in enumerate(dayadis):
+        versions = [version for (veridx, version) in enumerate(counts.versions) if include[dayidx, veridx]]
+        bytypedata = { 'versions': sorted(versions), 'adi': sum([adi[version] for version in versions]), 'crashes': {}}
+        for (colidx, (subfacet, term)) in enumerate(counts.columns):
+            pname = getTypeName(subfacet, term) if subfacet in type_subfacets else None
+            if pname and seen[dayidx, colidx]:
+                bytypedata['crashes'][pname] = bytypedata['crashes'].get(pname, 0) + sums[dayidx, colidx].item()
+        if global_defaults['collect_installs']:
+            bytypedata['installs'] = getInstalls(counts.columns, installsums[dayidx], seen[dayidx])
+        if versions:
+            bytypedata['crashes']['Browser'] = bytypedata['crashes'].get('Browser', 0) + browser[dayidx].item()
+        if 'OOP Plugin' in bytypedata['crashes'] and 'Hang Plugin' in bytypedata['crashes']:
+            bytypedata['crashes']['OOP Plugin'] -= bytypedata['crashes']['Hang Plugin']
+        bytypes[idx] = bytypedata
+    return bytypes
+
+# Get the installations affected by crashes of every type and overall
+# ('total') from the summed up columns of a day. Installations can't be
+# subtracted from each other like crashes, so there are none for the
+# browser process, and 'OOP Plugin' ones include those of plugin hangs.
+# Summing up over versions counts installations that crashed with more
+# than one version more than once.
+def getInstalls(columns, sums, seen):
+    installs = {}
+    for (colidx, (subfacet, term)) in enumerate(columns):
+        if not seen[colidx]:
+            continue
+        if subfacet == '_cardinality.install_time':
+            installs['total'] = sums[colidx].item()
+        elif subfacet.endswith('_installs'):
+            pname = getTypeName(subfacet[:-len('_installs')], term)
+            if pname:
+                installs[pname] = installs.get(pname, 0) + sums[colidx].item()
+    return installs
+
+# Get ADI and crashes of the days of a by-type dataset that have data, for rollups.
+def loadRollupDays(store, dataset, days):
+    return dict([(anaday, (data['adi'], data['crashes']))
+                 for (anaday, data) in store.getEntries(dataset, days).items()])
+
+# Collect the by-type data as a stage of a run, see createRunContext.
+def collect(ctx):
+    (forced_dates, anadayList, store) = (ctx['forced_dates'], ctx['anadayList'], ctx['store'])
 
     # Get platforms
-    results = getFromAPI('Platforms')
-    platforms = []
-    for plt in results:
-        platforms.append(plt["name"])
-
-    # Get a minimum start date older than any needed below:
-    # 1) First element in the anadayList is the earlist day we build stuff for.
-    # 2) For unknown channels, getMaxBuildAge returns a larger age value than for anything else.
-    earliest_mindate = dayStringBeforeDelta(anadayList[0], getMaxBuildAge('none'))
-    # Get all possibly needed versions for all products we look for.
-    all_versions = getFromAPI('ProductVersions', {
-        'product': prodchannels.keys(),
-        'start_date': '>' + earliest_mindate,
-        'is_rapid_beta': 'false',
-    })['hits']
+    platforms = getRunPlatforms(ctx)
 
     # By-type daily data
+    # First plan all the (product, channel, day) units we need to fetch data for.
+    datasets = []
+    units = []
     for (product, channels) in prodchannels.items():
         for channel in channels:
-            fprodtypedata = product + '-' + channel + '-crashes-bytype.json'
+            dprodtypedata = getCrashDataset(ctx, product, channel, 'bytype')
+            store.openDataset(dprodtypedata)
+            datasets.append(dprodtypedata)
 
-            try:
-                with open(fprodtypedata, 'r') as infile:
-                    print('Read stored ' + product + ' ' + channel.capitalize() + ' per-type data')
-                    prodtypedata = json.load(infile)
-            except IOError:
-                prodtypedata = {}
-
-            maxday = None
+            # We only need stored data for the days we look at.
+            prodtypedata = store.getEntries(dprodtypedata, anadayList)
 
             max_build_age = getMaxBuildAge(channel, True)
 
@@ -75,91 +314,93 @@ def run(*args):
                 # Do not fetch data when we already have data for this day (unless it's a forced date).
                 if anaday not in forced_dates and anaday in prodtypedata and prodtypedata[anaday]['adi']:
                     continue
+                # Or when a backfill we are resuming already got it.
+                if isBackfillDone(ctx, dprodtypedata, anaday):
+                    continue
 
                 print('Fetching ' + product + ' ' + channel.capitalize() + ' per-type daily data for ' + anaday)
 
-                # Could use build ID and directly go to Super Search but then we'd need to be able to match ADI with build IDs.
-                # For now, we don't use that and query versions instead. This would need a False flag on getMaxBuildAge.
-                #min_buildid = (datetime.datetime.strptime(anaday, '%Y-%m-%d') - max_build_age).strftime('%Y%m%d000000')
+                # On unthrottled channels, --buildid-window goes to Super Search directly by build ID
+                # and matches ADI with the versions found there, see getBuildIDParams.
+                if useBuildIDWindow(ctx, channel):
+                    # Versions only get known from the crash data, see fetchBuildIDUnits.
+                    units.append({
+                        'product': product,
+                        'channel': channel,
+                        'anaday': anaday,
+                        'dataset': dprodtypedata,
+                        'versions': None,
+                        'verinfo': getBuildIDVerinfo(),
+                        'buildid': True,
+                        'queries': [planCrashQuery(product, anaday, getBuildIDParams(channel, anaday))],
+                    })
+                    continue
 
                 # Get version list for this day, product and channel.
                 # This can contain more versions that we have data for, so don't exactly put this into the output!
-                min_verstartdate = dayStringBeforeDelta(anaday, max_build_age)
-                versions = []
-                verinfo = {}
-                for ver in all_versions:
-                    if ver['product'] == product and ver['build_type'] == channel and ver['start_date'] > min_verstartdate:
-                        versions.append(ver['version'])
-                        verinfo[ver['version']] = {'tfactor': 100 / ver['throttle']}
-
-                # Get ADI data.
-                adi = {}
-                results = getFromAPI('ADI', {
+                # All possibly needed versions for all products we look for are fetched once.
+                verindex = getRunVersionIndex(ctx, prodchannels.keys())
+                (versions, verinfo) = verindex.getActiveVersions(product, channel, anaday, max_build_age)
+
+                units.append({
                     'product': product,
+                    'channel': channel,
+                    'anaday': anaday,
+                    'dataset': dprodtypedata,
                     'versions': versions,
-                    'start_date': anaday,
-                    'end_date': anaday,
-                    'platforms': platforms,
+                    'verinfo': verinfo,
+                    'queries': planDayQueries(product, anaday, versions, platforms),
+                    # Forced days we have data for only get fetched again if their totals changed.
+                    'check': anaday in prodtypedata,
                 })
-                if not 'hits' in results:
-                    if 'error' in results:
-                        print('ERROR: ' + results['error'])
-                    else:
-                        print('ERROR: could not fetch ADI correctly!')
-                    continue
-                for adidata in results['hits']:
-                   adi[adidata['version']] = adidata['adi_count']
 
-                # Get crash data.
-                results = getFromAPI('SuperSearch', {
-                    'product': product,
-                    'version': versions,
-                    'date': ['>=' + anaday,
-                             '<' + dayStringAdd(anaday, days=1)],
-                    '_aggs.version': ['process_type', 'plugin_hang'],
-                    '_results_number': 0,
-                })
-                if not 'facets' in results or not 'version' in results['facets']:
-                    if 'error' in results:
-                        print('ERROR: ' + results['error'])
-                    else:
-                        print('ERROR: no versions facet present!')
-                    continue
+    # Cheaply check which of the days we have data for changed at all.
+    units = skipUnchangedUnits(ctx, units)
+
+    # Then fetch all ADI and crash data concurrently.
+    with timed('phase', 'bytype fetch'):
+        dayunits = [unit for unit in units if not unit.get('buildid')]
+        # Installations per type don't fit into the daily histogram of a batch.
+        if '--batch-days' in ctx['args'] and not global_defaults['collect_installs']:
+            fetchBatches(dayunits, platforms)
+        else:
+            fetchUnits(dayunits)
+        fetchBuildIDUnits([unit for unit in units if unit.get('buildid')], platforms)
+
+    # And merge the results back into the per-type data of each product and channel.
+    for unit in units:
+        recordUnitFetchTiming('bytype unit fetch', unit)
+    changed = dict([(dprodtypedata, []) for dprodtypedata in datasets])
+    for dprodtypedata in datasets:
+        dunits = [unit for unit in units if unit['dataset'] == dprodtypedata]
+        with timed('bytype processing', dprodtypedata):
+            bytypes = processResults(dunits)
+        for (unit, bytypedata) in zip(dunits, bytypes):
+            if bytypedata and bytypedata['adi']:
+                if store.put(unit['dataset'], unit['anaday'], bytypedata):
+                    changed[unit['dataset']].append(unit['anaday'])
+                setUnitFingerprint(ctx, unit, getResultsFingerprint(unit))
+                # Later stages of the same run can use this without asking the store.
+                ctx['bytype'].setdefault(unit['dataset'], {})[unit['anaday']] = bytypedata
+            if bytypedata:
+                markBackfillDone(ctx, unit['dataset'], unit['anaday'])
+    store.commit()
 
-                bytypedata = { 'versions': [], 'adi': 0, 'crashes': {}}
-                for vdata in results['facets']['version']:
-                    # only add the count for this version if the version has ADI.
-                    if vdata['term'] in versions and vdata['term'] in adi:
-                        bytypedata['versions'].append(vdata['term'])
-                        bytypedata['adi'] += adi[vdata['term']]
-                        nonbrowser = 0
-                        for hdata in vdata['facets']['plugin_hang']:
-                            if hdata['term'] == 'T':
-                                if 'Hang Plugin' not in bytypedata['crashes']:
-                                    bytypedata['crashes']['Hang Plugin'] = 0
-                                bytypedata['crashes']['Hang Plugin'] += hdata['count'] * verinfo[vdata['term']]['tfactor']
-                        for pdata in vdata['facets']['process_type']:
-                            if pdata['term'] == 'plugin':
-                                pname = 'OOP Plugin'
-                            else:
-                                pname = pdata['term'].capitalize()
-                            if pname not in bytypedata['crashes']:
-                                bytypedata['crashes'][pname] = 0
-                            bytypedata['crashes'][pname] += pdata['count'] * verinfo[vdata['term']]['tfactor']
-                            nonbrowser += pdata['count']
-                        if 'Browser' not in bytypedata['crashes']:
-                            bytypedata['crashes']['Browser'] = 0
-                        bytypedata['crashes']['Browser'] += (vdata['count'] - nonbrowser) * verinfo[vdata['term']]['tfactor']
-                if 'OOP Plugin' in bytypedata['crashes'] and 'Hang Plugin' in bytypedata['crashes']:
-                    bytypedata['crashes']['OOP Plugin'] -= bytypedata['crashes']['Hang Plugin']
-                bytypedata['versions'].sort()
-                if bytypedata['adi']:
-                    prodtypedata[anaday] = bytypedata
-
-            # Sort and write data back to the file.
-            ptd_sorted = OrderedDict(sorted(prodtypedata.items(), key=lambda t: t[0]))
-            with open(fprodtypedata, 'w') as outfile:
-                json.dump(ptd_sorted, outfile)
+    # Update rates and weekly/monthly sums for the days that changed.
+    for dprodtypedata in datasets:
+        updateRollups(store, dprodtypedata, functools.partial(loadRollupDays, store, dprodtypedata),
+                      changed[dprodtypedata])
+
+    # Write out the files for all data that changed.
+    with timed('phase', 'bytype export'):
+        for dprodtypedata in datasets:
+            store.exportJSON(dprodtypedata)
+
+# Run the actual meat of the script.
+def run(*args):
+    ctx = createRunContext(args, backlog_days)
+    runCollectors(ctx, [('bytype', collect)])
+    finishRun(ctx)
 
 
 # Avoid running the script when e.g. simply importing the file.
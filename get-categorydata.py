@@ -4,14 +4,17 @@ from __future__ import print_function  # to make print available in py3
 from pprint import pprint  # pretty print python objects
 
 import datetime
-import os
-import json
-from collections import OrderedDict
+import functools
 import re
-
-from datautils import (getFromAPI, global_defaults, verifyForcedDates,
-                       getMaxBuildAge, getDataPath, dayList,
-                       dayStringBeforeDelta, dayStringAdd)
+from datautils import (fetchUnits, batchUnits, splitDailyHistogram,
+                       global_defaults, getMaxBuildAge, createRunContext,
+                       getRunVersionIndex, runCollectors, finishRun, timed,
+                       isBackfillDone, markBackfillDone, recordUnitFetchTiming,
+                       getUnitName, dayStringAdd, setUnitFingerprint,
+                       skipUnchangedUnits, useBuildIDWindow, getBuildIDParams,
+                       getBuildIDVerinfo, getCrashDataset)
+from aggregation import loadVersionBuckets, stackDays
+from rollups import updateRollups
 
 # *** data gathering variables ***
 
@@ -84,54 +87,448 @@ reports = {
 # for how many days back to get the data
 backlog_days = global_defaults['socorrodata_backlog_days']
 
+# maximum number of signatures in a combined category query, if we get as
+# many back, the list may be cut off and we fall back to per-report queries
+combined_facets_size = 1000
+
 # *** URLs and paths ***
 
-# Run the actual meat of the script.
-def run(*args):
-    forced_dates = verifyForcedDates(args)
-    anadayList = dayList(backlog_days, forced_dates)
-
-    datapath = getDataPath()
-    if datapath is None:
-        print('ERROR: No data path found, aborting!')
-        import sys
-        sys.exit(1)
-    os.chdir(datapath);
-
-    # Get a minimum start date older than any needed below:
-    # 1) First element in the anadayList is the earlist day we build stuff for.
-    # 2) For unknown channels, getMaxBuildAge returns a larger age value than for anything else.
-    earliest_mindate = dayStringBeforeDelta(anadayList[0], getMaxBuildAge('none'))
-    # Get all possibly needed versions for all products we look for.
-    all_versions = getFromAPI('ProductVersions', {
-        'product': prodchannels.keys(),
-        'start_date': '>' + earliest_mindate,
-        'is_rapid_beta': 'false',
-    })['hits']
+# Get the sub-facets of the versions facet in crash data queries, including
+# the installations affected by the crashes if we collect those.
+def getVersionSubfacets():
+    if global_defaults['collect_installs']:
+        return ['process_type', '_cardinality.install_time']
+    return ['process_type']
+
+# Get the crash data queries for all categories of one product and day.
+# The crashes are selected by the given Super Search parameters, e.g. by
+# versions or build IDs.
+def planDayQueries(product, anaday, selector):
+    catnames = []
+    queries = []
+    for (catname, rep) in reports.items():
+        if rep['desktoponly'] and product != 'Firefox':
+            continue
+        ssparams = {
+            'product': product,
+            'date': ['>=' + anaday,
+                    '<' + dayStringAdd(anaday, days=1)],
+            '_aggs.version': getVersionSubfacets(),
+            '_results_number': 0,
+            '_facets': 'process_type',
+        }
+        ssparams.update(selector)
+        ssparams.update(rep['params'])
+        catnames.append(catname)
+        queries.append({'api': 'SuperSearch', 'params': ssparams})
+    return (catnames, queries)
+
+# Get the crash data queries for all categories of one product and a range
+# of consecutive days, which are split up by a daily date histogram.
+def planBatchQueries(product, days, versions):
+    catnames = []
+    queries = []
+    for (catname, rep) in reports.items():
+        if rep['desktoponly'] and product != 'Firefox':
+            continue
+        ssparams = {
+            'product': product,
+            'version': versions,
+            'date': ['>=' + days[0],
+                    '<' + dayStringAdd(days[-1], days=1)],
+            '_histogram.date.version': getVersionSubfacets(),
+            '_histogram_interval.date': '1d',
+            '_results_number': 0,
+        }
+        ssparams.update(rep['params'])
+        catnames.append(catname)
+        queries.append({'api': 'SuperSearch', 'params': ssparams})
+    return (catnames, queries)
+
+# Split the results of a batch into the per-day results of its units.
+# Returns False if they can't be split up by day.
+def splitBatchResults(batch):
+    dayterms = dict((unit['anaday'], unit['verinfo']) for unit in batch['units'])
+    catresults = {}
+    for (catname, results) in zip(batch['catnames'], batch['results']):
+        catresults[catname] = splitDailyHistogram(results, 'version', dayterms)
+        if catresults[catname] is None:
+            return False
+    for unit in batch['units']:
+        unit['results'] = [catresults[catname][unit['anaday']] for catname in unit['catnames']]
+    return True
+
+# Fetch data for the planned units with one batch of queries per product,
+# channel and range of consecutive days, falling back to per-day queries
+# for batches where that fails.
+def fetchBatches(units):
+    batches = []
+    # Versions of build ID windows are not known before fetching.
+    dayunits = [unit for unit in units if unit['buildid']]
+    for batchunits in batchUnits([unit for unit in units if not unit['buildid']]):
+        if len(batchunits) == 1:
+            dayunits.extend(batchunits)
+            continue
+        days = [unit['anaday'] for unit in batchunits]
+        versions = sorted(set([ver for unit in batchunits for ver in unit['verinfo']]))
+        (catnames, queries) = planBatchQueries(batchunits[0]['product'], days, versions)
+        batches.append({
+            'units': batchunits,
+            'catnames': catnames,
+            'queries': queries,
+        })
+    fetchUnits(batches)
+    for batch in batches:
+        if not splitBatchResults(batch):
+            print('Batched fetching failed for ' + batch['units'][0]['product'] + ' ' +
+                  batch['units'][0]['channel'].capitalize() + ', falling back to per-day queries.')
+            dayunits.extend(batch['units'])
+    fetchUnits(dayunits)
+
+# Get a Python regex matching (with re.match) the signatures a Super Search
+# signature filter value matches, or None if we can't evaluate that filter
+# locally.
+def getSignaturePattern(fvalue):
+    if fvalue.startswith('^'):
+        return re.escape(fvalue[1:])
+    elif fvalue.startswith('$'):
+        return '.*' + re.escape(fvalue[1:]) + r'\Z'
+    elif fvalue.startswith('='):
+        return re.escape(fvalue[1:]) + r'\Z'
+    elif fvalue.startswith('~'):
+        return '.*' + re.escape(fvalue[1:])
+    elif fvalue.startswith('@'):
+        return convertESRegex(fvalue[1:])
+    return None
+
+# Convert an Elasticsearch regex (always anchored, "..." quotes literal
+# strings, @ stands for any string) into a Python one, or return None if it
+# uses syntax we don't support.
+def convertESRegex(esregex):
+    pyregex = ''
+    inclass = False
+    pos = 0
+    while pos < len(esregex):
+        char = esregex[pos]
+        if char == '\\' and pos + 1 < len(esregex):
+            pyregex += re.escape(esregex[pos + 1])
+            pos += 2
+            continue
+        if inclass:
+            if char == ']':
+                inclass = False
+        elif char == '[':
+            inclass = True
+        elif char == '"':
+            end = esregex.find('"', pos + 1)
+            if end < 0:
+                return None
+            pyregex += re.escape(esregex[pos + 1:end])
+            pos = end + 1
+            continue
+        elif char == '@':
+            char = '.*'
+        elif char in '#&~<>':
+            return None
+        pyregex += char
+        pos += 1
+    return '(?:' + pyregex + r')\Z'
+
+# Classifier telling which reports a signature belongs to, from the filter
+# values of reports that only filter on signatures, evaluated locally.
+# Exact and prefix filter values are looked up in a trie, so their number
+# (e.g. the prefixes of address:pure) doesn't matter, and all other filter
+# values of a report are compiled into one regex.
+class SignatureClassifier(object):
+    def __init__(self, filters):
+        self.catnames = list(filters.keys())
+        # Trie nodes map characters to child nodes, and None to the reports
+        # with a prefix ending there and '' to those matching exactly there.
+        self.trie = {}
+        self.regexes = []
+        for (catname, fvalues) in filters.items():
+            patterns = []
+            for fvalue in fvalues:
+                if fvalue.startswith('^') or fvalue.startswith('='):
+                    node = self.trie
+                    for char in fvalue[1:]:
+                        node = node.setdefault(char, {})
+                    node.setdefault(None if fvalue.startswith('^') else '', set()).add(catname)
+                else:
+                    patterns.append('(?:' + getSignaturePattern(fvalue) + ')')
+            if patterns:
+                self.regexes.append((catname, re.compile('|'.join(patterns))))
+
+    # Get the set of reports a signature belongs to.
+    def classify(self, signature):
+        catnames = set()
+        node = self.trie
+        for char in signature:
+            catnames.update(node.get(None, ()))
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            catnames.update(node.get(None, ()))
+            catnames.update(node.get('', ()))
+        for (catname, regex) in self.regexes:
+            if catname not in catnames and regex.match(signature):
+                catnames.add(catname)
+        return catnames
+
+# Get the reports for a product that only filter on signatures which we can
+# evaluate locally, mapped to the list of their filter values.
+def getCombinableReports(product):
+    filters = {}
+    for (catname, rep) in reports.items():
+        if rep['desktoponly'] and product != 'Firefox':
+            continue
+        if list(rep['params'].keys()) != ['signature']:
+            continue
+        fvalues = rep['params']['signature']
+        if not isinstance(fvalues, list):
+            fvalues = [fvalues]
+        if None not in [getSignaturePattern(fvalue) for fvalue in fvalues]:
+            filters[catname] = fvalues
+    return filters
+
+# Get one query fetching crash data for all given signature-based reports at
+# once, aggregated by signature so we can tell the reports apart locally.
+# With classify, the query isn't filtered by signatures at all but gets all
+# of them, so reports can be added without more or more complex queries.
+def planCombinedQuery(product, anaday, selector, catnames, classify = False):
+    signatures = []
+    for catname in catnames:
+        fvalues = reports[catname]['params']['signature']
+        for fvalue in (fvalues if isinstance(fvalues, list) else [fvalues]):
+            if fvalue not in signatures:
+                signatures.append(fvalue)
+    ssparams = {
+        'product': product,
+        'date': ['>=' + anaday,
+                '<' + dayStringAdd(anaday, days=1)],
+        '_aggs.signature.version': getVersionSubfacets(),
+        '_facets_size': global_defaults['classify_facets_size'] if classify else combined_facets_size,
+        '_results_number': 0,
+    }
+    if not classify:
+        ssparams['signature'] = signatures
+    ssparams.update(selector)
+    return {'api': 'SuperSearch', 'params': ssparams}
+
+# Split the results of a combined query into results for every report as if
+# they had been fetched with their per-report queries. The signature buckets
+# can also come from a generator while the response is streamed in.
+# Returns None if the results are not made up as expected or may be cut off,
+# i.e. have as many signatures as facets_size.
+def splitCombinedResults(results, classifier, facets_size):
+    if not 'facets' in results or not 'signature' in results['facets']:
+        return None
+    counts = dict((catname, {}) for catname in classifier.catnames)
+    sigcount = 0
+    for sdata in results['facets']['signature']:
+        sigcount += 1
+        if not 'facets' in sdata or not 'version' in sdata['facets']:
+            return None
+        catnames = classifier.classify(sdata['term'])
+        for vdata in sdata['facets']['version']:
+            if not 'facets' in vdata or not 'process_type' in vdata['facets']:
+                return None
+            for catname in catnames:
+                if vdata['term'] not in counts[catname]:
+                    counts[catname][vdata['term']] = {'count': 0, 'process_type': {}}
+                vcounts = counts[catname][vdata['term']]
+                vcounts['count'] += vdata['count']
+                # Installations that crashed with multiple signatures get counted for each.
+                if 'cardinality_install_time' in vdata['facets']:
+                    vcounts['installs'] = (vcounts.get('installs', 0) +
+                                           vdata['facets']['cardinality_install_time']['value'])
+                for pdata in vdata['facets']['process_type']:
+                    if pdata['term'] not in vcounts['process_type']:
+                        vcounts['process_type'][pdata['term']] = 0
+                    vcounts['process_type'][pdata['term']] += pdata['count']
+    if sigcount >= facets_size:
+        return None
+
+    # Facet buckets are sorted by count, then term, like Super Search does it.
+    bucketorder = lambda bucket: (-bucket['count'], bucket['term'])
+    catresults = {}
+    for (catname, vcountlist) in counts.items():
+        vbuckets = []
+        for (version, vcounts) in vcountlist.items():
+            pbuckets = [{'term': ptype, 'count': pcount}
+                        for (ptype, pcount) in vcounts['process_type'].items()]
+            vbuckets.append({'term': version, 'count': vcounts['count'],
+                             'facets': {'process_type': sorted(pbuckets, key=bucketorder)}})
+            if 'installs' in vcounts:
+                vbuckets[-1]['facets']['cardinality_install_time'] = {'value': vcounts['installs']}
+        catresults[catname] = {'facets': {'version': sorted(vbuckets, key=bucketorder)}}
+    return catresults
+
+# Get the part of a unit fetching the combined query for its reports that
+# only filter on signatures, see planCombinedQuery.
+def planCombinedSubunit(unit, classifier, classify):
+    query = planCombinedQuery(unit['product'], unit['anaday'], unit['selector'],
+                              classifier.catnames, classify)
+    # Split up the results while fetching, so the large signature facet
+    # can be decoded incrementally and never needs to be kept.
+    query['stream'] = 'signature'
+    query['process'] = functools.partial(splitCombinedResults, classifier=classifier,
+                                         facets_size=query['params']['_facets_size'])
+    return {
+        'catnames': classifier.catnames,
+        'queries': [query],
+    }
+
+# Fetch data for the planned units with one combined query per unit for all
+# reports that only filter on signatures and per-report queries for the
+# rest, falling back to per-report queries where the combined one fails.
+# With classify, the combined query gets all signatures (see
+# planCombinedQuery), falling back to one filtered by signatures first.
+def fetchCombined(units, classify = False):
+    classifiers = {}
+    subunits = []
+    for unit in units:
+        if unit['product'] not in classifiers:
+            classifiers[unit['product']] = SignatureClassifier(getCombinableReports(unit['product']))
+        classifier = classifiers[unit['product']]
+        unit['separate'] = {'catnames': [], 'queries': []}
+        for (catname, query) in zip(unit['catnames'], unit['queries']):
+            if catname not in classifier.catnames:
+                unit['separate']['catnames'].append(catname)
+                unit['separate']['queries'].append(query)
+        unit['combined'] = planCombinedSubunit(unit, classifier, classify)
+        subunits.extend([unit['separate'], unit['combined']])
+    fetchUnits(subunits)
+
+    if classify:
+        refetch = []
+        for unit in units:
+            if unit['combined']['results'][0] is None:
+                print('Classifying all signatures failed for ' + unit['product'] + ' ' +
+                      unit['channel'].capitalize() + ' on ' + unit['anaday'] +
+                      ', falling back to a query filtered by signatures.')
+                unit['combined'] = planCombinedSubunit(unit, classifiers[unit['product']], False)
+                refetch.append(unit['combined'])
+        fetchUnits(refetch)
+
+    fallback = []
+    for unit in units:
+        catresults = dict(zip(unit['separate']['catnames'], unit['separate']['results']))
+        combresults = unit['combined']['results'][0]
+        if combresults is None:
+            print('Combined fetching failed for ' + unit['product'] + ' ' +
+                  unit['channel'].capitalize() + ' on ' + unit['anaday'] +
+                  ', falling back to per-report queries.')
+            unit['fallback'] = {'catnames': [], 'queries': []}
+            for (catname, query) in zip(unit['catnames'], unit['queries']):
+                if catname in unit['combined']['catnames']:
+                    unit['fallback']['catnames'].append(catname)
+                    unit['fallback']['queries'].append(query)
+            fallback.append(unit['fallback'])
+        else:
+            catresults.update(combresults)
+        unit['catresults'] = catresults
+    fetchUnits(fallback)
+
+    for unit in units:
+        if 'fallback' in unit:
+            unit['catresults'].update(zip(unit['fallback']['catnames'], unit['fallback']['results']))
+        unit['results'] = [unit['catresults'][catname] for catname in unit['catnames']]
+
+# Assemble the category data of units of one product and channel from their
+# crash data results. Returns the category data, overall crash count and
+# installations affected per category (if we collect those) of every unit
+# in the same order.
+def processResults(units):
+    catdatas = [{} for unit in units]
+    allcounts = [0] * len(units)
+    catinstalls = [{} for unit in units]
+    for catname in sorted(set([catname for unit in units for catname in unit['catnames']])):
+        rep = reports[catname]
+        dayidxs = []
+        tables = []
+        for (idx, unit) in enumerate(units):
+            if catname not in unit['catnames']:
+                continue
+            results = unit['results'][unit['catnames'].index(catname)]
+            if not 'facets' in results or not 'version' in results['facets']:
+                if 'error' in results:
+                    print('ERROR (' + getUnitName(unit) + ', ' + catname + '): ' + results['error'])
+                else:
+                    print('ERROR (' + getUnitName(unit) + ', ' + catname + '): no versions facet present!')
+                continue
+            dayidxs.append(idx)
+            tables.append(loadVersionBuckets(results['facets']['version'], getVersionSubfacets()))
+        if not tables:
+            continue
+
+        counts = stackDays(tables)
+        (weights, include) = counts.getWeights(
+            lambda dayidx, version: units[dayidxs[dayidx]]['verinfo'][version]['tfactor'])
+        installcol = (counts.columns.index(('_cardinality.install_time', None))
+                      if ('_cardinality.install_time', None) in counts.columns else None)
+        if rep['process_split'] or installcol is not None:
+            (sums, seen) = counts.sumColumns(weights, include)
+        if installcol is not None:
+            # Distinct installations can't be scaled up from throttled samples.
+            (installsums, seen) = counts.sumColumns(include.astype(int), include)
+        if rep['process_split']:
+            browser = counts.sumRemainder('process_type', weights, include)
+            hasversions = include.any(axis=1)
+        else:
+            catsums = counts.sumTotals(weights, include)
+        daytotals = counts.totals.sum(axis=1)
+        for (dayidx, idx) in enumerate(dayidxs):
+            if rep['process_split']:
+                catdata = {}
+                for (colidx, (subfacet, term)) in enumerate(counts.columns):
+                    if subfacet == 'process_type' and seen[dayidx, colidx]:
+                        catdata[term] = sums[dayidx, colidx].item()
+                if hasversions[dayidx]:
+                    catdata['browser'] = catdata.get('browser', 0) + browser[dayidx].item()
+                catdatas[idx][catname] = catdata
+            else:
+                catdatas[idx][catname] = catsums[dayidx].item()
+            allcounts[idx] += daytotals[dayidx].item()
+            if installcol is not None and seen[dayidx, installcol]:
+                catinstalls[idx][catname] = installsums[dayidx, installcol].item()
+    return list(zip(catdatas, allcounts, catinstalls))
+
+# Get ADI (from by-type data) and crashes of the days of a category dataset
+# that have data, for rollups.
+def loadRollupDays(store, dataset, typedataset, days):
+    catdata = store.getEntries(dataset, days)
+    typedata = store.getEntries(typedataset, list(catdata.keys()))
+    return dict([(anaday, (typedata[anaday]['adi'], data))
+                 for (anaday, data) in catdata.items() if anaday in typedata])
+
+# Collect the category data as a stage of a run, see createRunContext.
+def collect(ctx):
+    (forced_dates, anadayList, store) = (ctx['forced_dates'], ctx['anadayList'], ctx['store'])
 
     # Get daily category data
+    # First plan all the (product, channel, day) units we need to fetch data for.
+    datasets = []
+    units = []
     for (product, channels) in prodchannels.items():
         for channel in channels:
-            fprodcatdata = product + '-' + channel + '-crashes-categories.json'
-            fprodtypedata = product + '-' + channel + '-crashes-bytype.json'
-
-            try:
-                with open(fprodcatdata, 'r') as infile:
-                    print('Read stored ' + product + ' ' + channel.capitalize() + ' category data')
-                    prodcatdata = json.load(infile)
-            except IOError:
-                print('No previous category data found.')
-                prodcatdata = {}
-
-            try:
-                with open(fprodtypedata, 'r') as infile:
-                    print('Read stored ' + product + ' ' + channel.capitalize() + ' per-type data')
-                    prodtypedata = json.load(infile)
-            except IOError:
-                print('ERROR: no per-type data found!')
-                prodtypedata = {}
-
-            maxday = None
+            dprodcatdata = getCrashDataset(ctx, product, channel, 'categories')
+            dprodtypedata = getCrashDataset(ctx, product, channel, 'bytype')
+            store.openDataset(dprodcatdata)
+            store.openDataset(dprodtypedata)
+            if global_defaults['collect_installs']:
+                store.openDataset(dprodcatdata + '-installs')
+            datasets.append(dprodcatdata)
+
+            # We only need stored data for the days we look at.
+            # By-type data collected earlier in this run doesn't need to come from the store.
+            prodcatdata = store.getEntries(dprodcatdata, anadayList)
+            prodtypedata = ctx['bytype'].get(dprodtypedata, {}).copy()
+            prodtypedata.update(store.getEntries(dprodtypedata,
+                                                 [anaday for anaday in anadayList if anaday not in prodtypedata]))
+            if not prodtypedata:
+                print('ERROR: no per-type data found for ' + product + ' ' + channel.capitalize() + '!')
 
             max_build_age = getMaxBuildAge(channel, True)
 
@@ -139,73 +536,97 @@ def run(*args):
                 # Do not fetch data when we already have data for this day (unless it's a forced date) or if we don't have by-type data.
                 if (anaday not in forced_dates and anaday in prodcatdata) or anaday not in prodtypedata:
                     continue
+                # Or when a backfill we are resuming already got it.
+                if isBackfillDone(ctx, dprodcatdata, anaday):
+                    continue
 
                 print('Category Counts: Looking at category data for ' + product + ' ' + channel.capitalize() + ' on ' + anaday)
 
-                # Could use build ID and directly go to Super Search but then we'd need to be able to match ADI with build IDs.
-                # For now, we don't use that and query versions instead. This would need a False flag on getMaxBuildAge.
-                #min_buildid = (datetime.datetime.strptime(anaday, '%Y-%m-%d') - max_build_age).strftime('%Y%m%d000000')
-
                 # Get version list for this day, product and channel.
                 # This can contain more versions that we have data for, so don't exactly put this into the output!
-                min_verstartdate = dayStringBeforeDelta(anaday, max_build_age)
-                versions = []
-                verinfo = {}
-                for ver in all_versions:
-                    if ver['product'] == product and ver['build_type'] == channel and ver['start_date'] > min_verstartdate:
-                        versions.append(ver['version'])
-                        verinfo[ver['version']] = {'tfactor': 100 / ver['throttle']}
+                # On unthrottled channels, --buildid-window goes to Super Search directly by build ID
+                # and the versions come from the results, see getBuildIDParams.
+                if useBuildIDWindow(ctx, channel):
+                    (versions, verinfo) = (None, getBuildIDVerinfo())
+                    selector = getBuildIDParams(channel, anaday)
+                else:
+                    # All possibly needed versions for all products we look for are fetched once.
+                    verindex = getRunVersionIndex(ctx, prodchannels.keys())
+                    (versions, verinfo) = verindex.getActiveVersions(product, channel, anaday, max_build_age)
+                    selector = {'version': versions}
 
-                catdata = {}
-                allcount = 0
-                for (catname, rep) in reports.items():
-                    if rep['desktoponly'] and product != 'Firefox':
-                        continue
-                    print('    * ' + catname)
-
-                    # Get crash data.
-                    ssparams = {
-                        'product': product,
-                        'version': versions,
-                        'date': ['>=' + anaday,
-                                '<' + dayStringAdd(anaday, days=1)],
-                        '_aggs.version': ['process_type'],
-                        '_results_number': 0,
-                        '_facets': 'process_type',
-                    }
-                    ssparams.update(rep['params'])
-                    results = getFromAPI('SuperSearch', ssparams)
-                    if not 'facets' in results or not 'version' in results['facets']:
-                        if 'error' in results:
-                            print('ERROR: ' + results['error'])
-                        else:
-                            print('ERROR: no versions facet present!')
-                        continue
-                    if rep['process_split']:
-                        catdata[catname] = {}
-                        for vdata in results['facets']['version']:
-                            nonbrowser = 0
-                            for pdata in vdata['facets']['process_type']:
-                                if pdata['term'] not in catdata[catname]:
-                                    catdata[catname][pdata['term']] = 0
-                                catdata[catname][pdata['term']] += pdata['count'] * verinfo[vdata['term']]['tfactor']
-                                nonbrowser += pdata['count']
-                            if 'browser' not in catdata[catname]:
-                                catdata[catname]['browser'] = 0
-                            catdata[catname]['browser'] += (vdata['count'] - nonbrowser) * verinfo[vdata['term']]['tfactor']
-                            allcount += vdata['count']
-                    else:
-                        catdata[catname] = 0
-                        for vdata in results['facets']['version']:
-                            catdata[catname] += vdata['count'] * verinfo[vdata['term']]['tfactor']
-                            allcount += vdata['count']
+                (catnames, queries) = planDayQueries(product, anaday, selector)
+                units.append({
+                    'product': product,
+                    'channel': channel,
+                    'anaday': anaday,
+                    'dataset': dprodcatdata,
+                    'versions': versions,
+                    'verinfo': verinfo,
+                    'selector': selector,
+                    'buildid': versions is None,
+                    'catnames': catnames,
+                    'queries': queries,
+                    # Forced days we have data for only get fetched again if their totals changed.
+                    'check': anaday in prodcatdata and versions is not None,
+                })
+
+    # Cheaply check which of the days we have data for changed at all.
+    units = skipUnchangedUnits(ctx, units)
+
+    # Then fetch all crash data concurrently.
+    with timed('phase', 'category fetch'):
+        if '--classify-signatures' in ctx['args']:
+            fetchCombined(units, classify=True)
+        elif '--combine-categories' in ctx['args']:
+            fetchCombined(units)
+        elif '--batch-days' in ctx['args']:
+            fetchBatches(units)
+        else:
+            fetchUnits(units)
+
+    # And merge the results back into the category data of each product and channel.
+    for unit in units:
+        recordUnitFetchTiming('category unit fetch', unit)
+    changed = dict([(dprodcatdata, []) for dprodcatdata in datasets])
+    for dprodcatdata in datasets:
+        dunits = [unit for unit in units if unit['dataset'] == dprodcatdata]
+        with timed('category processing', dprodcatdata):
+            catresults = processResults(dunits)
+        for (unit, (catdata, allcount, catinstalls)) in zip(dunits, catresults):
+            if allcount:
+                if store.put(unit['dataset'], unit['anaday'], catdata):
+                    changed[unit['dataset']].append(unit['anaday'])
+                if global_defaults['collect_installs']:
+                    store.put(unit['dataset'] + '-installs', unit['anaday'], catinstalls)
+            if set(catdata.keys()) == set(unit['catnames']):
+                markBackfillDone(ctx, unit['dataset'], unit['anaday'])
+                # Category data is complete for the totals we know for this day.
                 if allcount:
-                    prodcatdata[anaday] = catdata
+                    setUnitFingerprint(ctx, unit, unit.get('fingerprint') or ctx['fingerprints'].get(
+                        (unit['product'], unit['channel'], unit['anaday'])))
+    store.commit()
 
-            # Sort and write data back to the file.
-            ptd_sorted = OrderedDict(sorted(prodcatdata.items(), key=lambda t: t[0]))
-            with open(fprodcatdata, 'w') as outfile:
-                json.dump(ptd_sorted, outfile)
+    # Update rates and weekly/monthly sums for the days that changed,
+    # including those where the by-type ADI changed.
+    for dprodcatdata in datasets:
+        dprodtypedata = dprodcatdata.replace('-crashes-categories', '-crashes-bytype')
+        updateRollups(store, dprodcatdata,
+                      functools.partial(loadRollupDays, store, dprodcatdata, dprodtypedata),
+                      changed[dprodcatdata], anadayList)
+
+    # Write out the files for all data that changed.
+    with timed('phase', 'category export'):
+        for dprodcatdata in datasets:
+            store.exportJSON(dprodcatdata)
+            if global_defaults['collect_installs']:
+                store.exportJSON(dprodcatdata + '-installs')
+
+# Run the actual meat of the script.
+def run(*args):
+    ctx = createRunContext(args, backlog_days)
+    runCollectors(ctx, [('category', collect)])
+    finishRun(ctx)
 
 
 # Avoid running the script when e.g. simply importing the file.
@@ -4,12 +4,9 @@ from __future__ import print_function  # to make print available in py3
 from pprint import pprint  # pretty print python objects
 
 import datetime
-import os
-import json
-from collections import OrderedDict
-
-from datautils import (getFromAPI, global_defaults, getDataPath,
-                       beforeTodayString)
+from datautils import (getFromAPI, fetchAll, global_defaults, VersionIndex,
+                       beforeTodayString, dayStringAdd, createRunContext, getRunVersionIndex,
+                       runCollectors, finishRun, isBackfillDone, markBackfillDone)
 
 # *** data gathering variables ***
 
@@ -19,74 +16,157 @@ products = ['Firefox', 'FennecAndroid']
 # for how many days back to get the data
 backlog_days = global_defaults['socorrodata_backlog_days']
 
+# With --shard-daily, the daily data is fetched in concurrent requests for
+# groups of this many versions ...
+shard_versions = 4
+# ... and this many days each.
+shard_days = 7
+
+# how often to retry shards that failed, failed shards of multiple versions
+# get split into single versions so a bad version doesn't fail the others
+shard_retries = 2
+
 # *** URLs and paths ***
 
-# Run the actual meat of the script.
-def run():
-    # Get start and end dates
-    day_start = beforeTodayString(days=backlog_days)
-    day_end = beforeTodayString(days=1)
-
-    datapath = getDataPath()
-    if datapath is None:
-        print('ERROR: No data path found, aborting!')
-        import sys
-        sys.exit(1)
-    os.chdir(datapath);
+# Put CrashesPerAdu results for versions into the daily dataset.
+# Returns the last day that has data.
+def storeDailyResults(store, dataset, results, verinfo):
+    maxday = None
+    for (pver, pvdata) in results['hits'].items():
+        for (day, pvd) in pvdata.items():
+            ver = pvd['version']
+            crashes = pvd['report_count'] * verinfo[ver]['tfactor']
+            adu = pvd['adu']
+            if crashes or adu:
+                store.put(dataset, ver, {'crashes': crashes, 'adu': adu}, subkey=day)
+            if maxday is None or maxday < day:
+                maxday = day
+    return maxday
+
+# Split the CrashesPerAdu query of a product into shards by groups of
+# versions and ranges of days.
+def getDailyShards(product, versions, day_start, day_end):
+    shards = []
+    for verpos in range(0, len(versions), shard_versions):
+        from_date = day_start
+        while from_date <= day_end:
+            to_date = min(dayStringAdd(from_date, days=shard_days - 1), day_end)
+            shards.append({'api': 'CrashesPerAdu', 'params': {
+                'product': product,
+                'versions': versions[verpos:verpos + shard_versions],
+                'from_date': from_date,
+                'to_date': to_date,
+            }})
+            from_date = dayStringAdd(to_date, days=1)
+    return shards
+
+# Fetch the daily data of a product in concurrent shards, see getDailyShards,
+# retrying only the shards that failed. Returns a list of the results of all
+# successful shards and a list of the errors of the ones that failed.
+def fetchDailyShards(product, versions, day_start, day_end):
+    shards = getDailyShards(product, versions, day_start, day_end)
+    shardresults = []
+    for attempt in range(shard_retries + 1):
+        failed = []
+        for (shard, results) in zip(shards, fetchAll(shards)):
+            if 'hits' in results:
+                shardresults.append(results)
+            else:
+                failed.append((shard, results))
+        if not failed or attempt == shard_retries:
+            break
+        print('--- Retrying ' + str(len(failed)) + ' of ' + str(len(shards)) + ' daily data shards for ' + product)
+        shards = []
+        for (shard, results) in failed:
+            for version in shard['params']['versions']:
+                params = dict(shard['params'])
+                params['versions'] = [version]
+                shards.append({'api': shard['api'], 'params': params})
+    errors = [shard['params']['from_date'] + ' to ' + shard['params']['to_date'] + ' of ' +
+              ', '.join(shard['params']['versions']) + ': ' +
+              results.get('error', 'could not fetch daily data correctly!')
+              for (shard, results) in failed]
+    return (shardresults, errors)
+
+# Collect the daily data as a stage of a run, see createRunContext.
+def collect(ctx):
+    # Get start and end dates, a daemon cycle only needs the days it looks at.
+    if ctx['backfill'] or ctx['daemon']:
+        day_start = ctx['anadayList'][0]
+        day_end = min(ctx['anadayList'][-1], beforeTodayString(days=1))
+        if day_start > day_end:
+            return
+    else:
+        day_start = beforeTodayString(days=backlog_days)
+        day_end = beforeTodayString(days=1)
+
+    store = ctx['store']
 
     for product in products:
-        fproddata = product + '-crashes-daily.json'
-
-        try:
-            with open(fproddata, 'r') as infile:
-                print('Read stored ' + product + ' daily data')
-                proddata = json.load(infile)
-        except IOError:
-            proddata = {}
-
-        # Get all active versions for that product.
-        ver_results = getFromAPI('ProductVersions', {
-            'product': product,
-            'active': 'true',
-        })
-        versions = []
-        verinfo = {}
-        for ver in ver_results['hits']:
-            versions.append(ver['version'])
-            verinfo[ver['version']] = {'tfactor': 100 / ver['throttle']}
+        # Daily data is stored per version and day.
+        dproddata = product + '-crashes-daily'
+        store.openDataset(dproddata, nested=True)
+
+        if ctx['daemon']:
+            # The older days of a daemon cycle only get fetched if they are missing.
+            days = [anaday for anaday in ctx['anadayList'] if anaday <= day_end and
+                    (anaday in ctx['forced_dates'] or not store.getSubkeyRange(dproddata, anaday, anaday))]
+            if not days:
+                continue
+            day_start = days[0]
+
+        if ctx['backfill']:
+            days = [anaday for anaday in ctx['anadayList'] if anaday <= day_end]
+            if all([isBackfillDone(ctx, dproddata, anaday) for anaday in days]):
+                continue
+            # Get all versions that were active in the backfilled days.
+            verindex = getRunVersionIndex(ctx, products)
+            (versions, verinfo) = verindex.getProductVersionsInRange(product, day_start, day_end)
+        else:
+            # Get all active versions for that product.
+            verindex = VersionIndex(getFromAPI('ProductVersions', {
+                'product': product,
+                'active': 'true',
+            })['hits'])
+            (versions, verinfo) = verindex.getProductVersions(product)
 
         print('Fetch daily data for ' + product + ' ' + ', '.join(versions))
 
         # Get data for those versions and days.
-        maxday = None
-
-        results = getFromAPI('CrashesPerAdu', {
-            'product': product,
-            'versions': versions,
-            'from_date': day_start,
-            'to_date': day_end,
-        })
-        for (pver, pvdata) in results['hits'].items():
-            for (day, pvd) in pvdata.items():
-                ver = pvd['version']
-                crashes = pvd['report_count'] * verinfo[ver]['tfactor']
-                adu = pvd['adu']
-                if crashes or adi:
-                    if ver not in proddata:
-                        proddata[ver] = {}
-                    proddata[ver][day] = {'crashes': crashes, 'adu': adu}
-                if maxday is None or maxday < day:
-                    maxday = day
+        if '--shard-daily' in ctx['args']:
+            (shardresults, errors) = fetchDailyShards(product, versions, day_start, day_end)
+            for error in errors:
+                print('--- ERROR: ' + error)
+            if not shardresults:
+                continue
+        else:
+            results = getFromAPI('CrashesPerAdu', {
+                'product': product,
+                'versions': versions,
+                'from_date': day_start,
+                'to_date': day_end,
+            })
+            if not 'hits' in results:
+                print('--- ERROR: ' + results.get('error', 'could not fetch daily data correctly!'))
+                continue
+            (shardresults, errors) = ([results], [])
+        maxday = max([storeDailyResults(store, dproddata, results, verinfo)
+                      for results in shardresults])
         if maxday < day_end:
             print('--- ERROR: Last day retrieved is ' + maxday + ' while yesterday was ' + day_end + '!')
 
+        # Write out the file if the data changed.
+        store.commit()
+        store.exportJSON(dproddata)
+        if ctx['backfill'] and not errors:
+            for anaday in days:
+                markBackfillDone(ctx, dproddata, anaday)
 
-        # Sort and write data back to the file.
-        pd_sorted = OrderedDict()
-        for version in sorted(proddata.iterkeys()):
-           pd_sorted[version] = OrderedDict(sorted(proddata[version].items(), key=lambda t: t[0]))
-        with open(fproddata, 'w') as outfile:
-            json.dump(pd_sorted, outfile)
+# Run the actual meat of the script.
+def run(*args):
+    ctx = createRunContext(args, backlog_days)
+    runCollectors(ctx, [('daily', collect)])
+    finishRun(ctx)
 
 
 # Avoid running the script when e.g. simply importing the file.
@@ -0,0 +1,226 @@
+# Detect explosive crash signatures, i.e. signatures that suddenly crash a lot
+# more than they used to, on every channel of Firefox desktop and Android.
+# The signature facet of every day gets fetched only once and appended to a
+# per-signature time series in the data store, and spike detection only runs
+# on days that are new or changed, so the daily cost doesn't depend on the
+# length of the backlog.
+
+from __future__ import print_function  # to make print available in py3
+
+from datautils import (fetchUnits, global_defaults, getMaxBuildAge,
+                       createRunContext, getRunVersionIndex, runCollectors,
+                       finishRun, timed, isBackfillDone, markBackfillDone,
+                       recordUnitFetchTiming, getUnitName, dayStringAdd,
+                       beforeTodayString, dayList)
+
+# *** data gathering variables ***
+
+# products and channels to detect explosive signatures on
+prodchannels = {
+  'Firefox': ['release', 'beta', 'aurora', 'nightly'],
+  'FennecAndroid': ['release', 'beta', 'aurora', 'nightly']
+}
+
+# for how many days back to get the data, this is also the window of days
+# the signature time series are kept for and the baseline is taken from
+backlog_days = global_defaults['explosive_backlog_days']
+
+# number of top signatures to fetch the counts of every day
+signature_facets_size = 300
+
+# minimum number of crashes a signature needs to have on a day to be explosive
+explosive_min_count = 10
+
+# how many times the expected crashes a signature needs to have on a day to be explosive
+explosive_factor = 3
+
+# minimum number of earlier days with data in the window needed to detect spikes on a day
+explosive_min_baseline_days = 5
+
+# *** URLs and paths ***
+
+# Get the signature facet query for one product and day.
+def planDayQueries(product, anaday, versions):
+    return [
+        {'api': 'SuperSearch', 'params': {
+            'product': product,
+            'version': versions,
+            'date': ['>=' + anaday,
+                     '<' + dayStringAdd(anaday, days=1)],
+            '_facets': 'signature',
+            '_facets_size': signature_facets_size,
+            '_results_number': 0,
+        }},
+    ]
+
+# Store the signature counts and total crashes of a unit in the time series
+# datasets. Returns True if they changed, None if the results are missing.
+def storeSignatureCounts(store, unit):
+    results = unit['results'][0]
+    if not 'facets' in results or not 'signature' in results['facets'] or not 'total' in results:
+        if 'error' in results:
+            print('ERROR (' + getUnitName(unit) + '): ' + results['error'])
+        else:
+            print('ERROR (' + getUnitName(unit) + '): no signature facet present!')
+        return None
+    (dsigdata, dtotaldata) = unit['datasets']
+    sigcounts = dict([(sdata['term'], sdata['count']) for sdata in results['facets']['signature']])
+    oldcounts = dict([(signature, days[unit['anaday']]) for (signature, days) in
+                      store.getSubkeyRange(dsigdata, unit['anaday'], unit['anaday']).items()])
+    changed = store.put(dtotaldata, unit['anaday'], {'total': results['total']})
+    if sigcounts != oldcounts:
+        store.deleteSubkey(dsigdata, unit['anaday'])
+        for (signature, count) in sigcounts.items():
+            store.put(dsigdata, signature, count, subkey=unit['anaday'])
+        changed = True
+    return changed
+
+# Find the explosive signatures of a day from the time series of signature
+# counts and total crashes of the days in the window before it. A signature
+# is expected to have the same share of all crashes as it had in those days
+# together, and is explosive if it has a lot more crashes than that.
+# Returns None if there are not enough earlier days to tell.
+def getExplosiveSignatures(anaday, sigseries, totals):
+    basedays = [day for day in totals
+                if dayStringAdd(anaday, days=-(backlog_days - 1)) <= day < anaday]
+    if anaday not in totals or len(basedays) < explosive_min_baseline_days:
+        return None
+    basetotal = sum([totals[day] for day in basedays])
+    explosive = {}
+    for (signature, days) in sigseries.items():
+        count = days.get(anaday, 0)
+        if count < explosive_min_count:
+            continue
+        basecount = sum([days.get(day, 0) for day in basedays])
+        expected = totals[anaday] * float(basecount) / basetotal if basetotal else 0
+        factor = count / max(expected, 1.0)
+        if factor >= explosive_factor:
+            explosive[signature] = {
+                'count': count,
+                'expected': round(expected, 2),
+                'factor': round(factor, 2),
+            }
+    return explosive
+
+# Run spike detection on the days that changed and on the later days whose
+# window includes them. Returns the days whose explosive data changed.
+def updateExplosive(store, datasets, changeddays):
+    (dsigdata, dtotaldata, dexpdata) = datasets
+    if not changeddays:
+        return []
+    storeddays = store.getKeys(dtotaldata)
+    evaldays = [anaday for anaday in storeddays
+                if any([changed <= anaday < dayStringAdd(changed, days=backlog_days)
+                        for changed in changeddays])]
+    if not evaldays:
+        return []
+    firstday = dayStringAdd(evaldays[0], days=-(backlog_days - 1))
+    sigseries = store.getSubkeyRange(dsigdata, firstday, evaldays[-1])
+    totals = dict([(anaday, data['total']) for (anaday, data) in
+                   store.getEntries(dtotaldata, [anaday for anaday in storeddays
+                                                 if firstday <= anaday <= evaldays[-1]]).items()])
+    updated = []
+    for anaday in evaldays:
+        explosive = getExplosiveSignatures(anaday, sigseries, totals)
+        if explosive is not None and store.put(dexpdata, anaday, explosive):
+            updated.append(anaday)
+    return updated
+
+# Collect the explosive signature data as a stage of a run, see createRunContext.
+def collect(ctx):
+    (forced_dates, anadayList, store) = (ctx['forced_dates'], ctx['anadayList'], ctx['store'])
+
+    # A run of e.g. get-alldata can cover fewer days than our backlog, add
+    # the older days of it so all analyzed days get a full baseline window.
+    if not ctx['backfill']:
+        runfirstday = beforeTodayString(days=ctx['backlog_days'] - 1)
+        anadayList = sorted(set(anadayList) |
+                            set([anaday for anaday in dayList(backlog_days) if anaday < runfirstday]))
+
+    # Get all possibly needed versions for all products we look for.
+    verindex = getRunVersionIndex(ctx, prodchannels.keys())
+
+    # First plan all the (product, channel, day) units we need to fetch data for.
+    recentday = beforeTodayString(days=1)
+    datasets = []
+    units = []
+    for (product, channels) in prodchannels.items():
+        for channel in channels:
+            dsigdata = product + '-' + channel + '-crashes-signatures'
+            dtotaldata = product + '-' + channel + '-crashes-signaturetotals'
+            dexpdata = product + '-' + channel + '-crashes-explosive'
+            store.openDataset(dsigdata, nested=True)
+            store.openDataset(dtotaldata)
+            store.openDataset(dexpdata)
+            datasets.append((dsigdata, dtotaldata, dexpdata))
+
+            # Days are only fetched once unless they are forced or recent.
+            totaldata = store.getEntries(dtotaldata, anadayList)
+
+            max_build_age = getMaxBuildAge(channel, True)
+
+            for anaday in anadayList:
+                # The most recent days are still incomplete, so they get fetched again.
+                if anaday not in forced_dates and anaday < recentday and anaday in totaldata:
+                    continue
+                # Or when a backfill we are resuming already got it.
+                if isBackfillDone(ctx, dexpdata, anaday):
+                    continue
+
+                print('Fetching ' + product + ' ' + channel.capitalize() + ' signature data for ' + anaday)
+
+                (versions, verinfo) = verindex.getActiveVersions(product, channel, anaday, max_build_age)
+
+                units.append({
+                    'product': product,
+                    'channel': channel,
+                    'anaday': anaday,
+                    'datasets': (dsigdata, dtotaldata),
+                    'dataset': dexpdata,
+                    'versions': versions,
+                    'queries': planDayQueries(product, anaday, versions),
+                })
+
+    # Then fetch all signature data concurrently.
+    with timed('phase', 'explosive fetch'):
+        fetchUnits(units)
+
+    # Append it to the time series and detect spikes on the days that changed.
+    for unit in units:
+        recordUnitFetchTiming('explosive unit fetch', unit)
+    for (dsigdata, dtotaldata, dexpdata) in datasets:
+        changeddays = []
+        for unit in [unit for unit in units if unit['dataset'] == dexpdata]:
+            changed = storeSignatureCounts(store, unit)
+            if changed:
+                changeddays.append(unit['anaday'])
+            if changed is not None:
+                markBackfillDone(ctx, dexpdata, unit['anaday'])
+        with timed('explosive processing', dexpdata):
+            for anaday in updateExplosive(store, (dsigdata, dtotaldata, dexpdata), changeddays):
+                print('Updated explosive signatures of ' + dexpdata + ' for ' + anaday)
+        # Only keep the time series of what the analyzed days need as their
+        # baseline, including the days a daemon cycle doesn't analyze.
+        if anadayList:
+            firstday = min(anadayList[0], beforeTodayString(days=ctx['backlog_days'] - 1))
+            before = dayStringAdd(firstday, days=-(backlog_days - 1))
+            store.pruneSubkeys(dsigdata, before)
+            store.pruneKeys(dtotaldata, before)
+    store.commit()
+
+    # Write out the files for all data that changed.
+    with timed('phase', 'explosive export'):
+        for (dsigdata, dtotaldata, dexpdata) in datasets:
+            store.exportJSON(dexpdata)
+
+# Run the actual meat of the script.
+def run(*args):
+    ctx = createRunContext(args, backlog_days)
+    runCollectors(ctx, [('explosive', collect)])
+    finishRun(ctx)
+
+
+# Avoid running the script when e.g. simply importing the file.
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
@@ -0,0 +1,123 @@
+# Rollups of daily crash data, used by the by-type and category scripts.
+# Next to a dataset of daily counts, three derived datasets are kept so
+# dashboards don't need to download and crunch the full daily history:
+#   <dataset>-rates: crashes per 100 ADI of every day and their 7-day
+#                    moving average (summed crashes over summed ADI)
+#   <dataset>-weekly: summed ADI and crashes and their rates per week,
+#                     keyed by the Monday the week starts with
+#   <dataset>-monthly: the same per month, keyed by YYYY-MM
+# Only days that changed (and the windows and periods they are part of)
+# get recomputed.
+
+from __future__ import print_function  # to make print available in py3
+
+from datautils import dayStringAdd, parseDay, timed
+
+# number of days in the moving average
+moving_average_days = 7
+
+# number of decimals to round rates to
+rate_decimals = 4
+
+# Add crash counts, which are numbers or (nested) dicts of numbers, e.g. the
+# per-type crashes of by-type data or the per-category data.
+def addCounts(total, counts):
+    if not isinstance(counts, dict):
+        return (total or 0) + counts
+    total = dict(total or {})
+    for (key, value) in counts.items():
+        total[key] = addCounts(total.get(key), value)
+    return total
+
+# Get crashes per 100 ADI for crash counts, see addCounts.
+def getRates(counts, adi):
+    if isinstance(counts, dict):
+        return dict([(key, getRates(value, adi)) for (key, value) in counts.items()])
+    return round(counts * 100.0 / adi, rate_decimals) if adi else None
+
+def getWeekStart(anaday):
+    return dayStringAdd(anaday, days=-parseDay(anaday).weekday())
+
+def getMonth(anaday):
+    return anaday[:7]
+
+# Sum up ADI and crashes of a number of days, given as a dict of day to
+# (adi, crash counts), into a rollup entry.
+def sumDays(daydata):
+    adi = 0
+    crashes = None
+    for (anaday, (dayadi, daycrashes)) in sorted(daydata.items()):
+        adi += dayadi
+        crashes = addCounts(crashes, daycrashes)
+    return {'days': len(daydata), 'adi': adi, 'crashes': crashes or {},
+            'rate': getRates(crashes or {}, adi)}
+
+# Update the rollups of a dataset. loaddays is a function returning a dict of
+# day to (adi, crash counts) for the days that have data from a list of days.
+# The rollups of changeddays are recomputed, as well as those of checkdays
+# whose ADI changed since the last rollup. A rollup that doesn't exist yet
+# is computed for all days of the dataset.
+def updateRollups(store, dataset, loaddays, changeddays, checkdays = None):
+    ratesset = dataset + '-rates'
+    weeklyset = dataset + '-weekly'
+    monthlyset = dataset + '-monthly'
+    for rollupset in [ratesset, weeklyset, monthlyset]:
+        store.openDataset(rollupset)
+
+    changeddays = set(changeddays)
+    if not store.getKeys(ratesset):
+        changeddays.update(store.getKeys(dataset))
+    elif checkdays:
+        # e.g. category rates depend on by-type ADI which can change independently.
+        rates = store.getEntries(ratesset, checkdays)
+        for (anaday, (adi, crashes)) in loaddays(checkdays).items():
+            if anaday not in rates or rates[anaday]['adi'] != adi:
+                changeddays.add(anaday)
+    if not changeddays:
+        return
+
+    with timed('rollups', dataset):
+        # Daily rates, where the moving average also changes for the days
+        # after a changed day.
+        ratedays = set([dayStringAdd(anaday, days=offset) for anaday in changeddays
+                        for offset in range(moving_average_days)])
+        windowdays = set([dayStringAdd(anaday, days=-offset) for anaday in ratedays
+                          for offset in range(moving_average_days)])
+        daydata = loaddays(sorted(windowdays))
+        for anaday in sorted(ratedays):
+            if anaday not in daydata:
+                continue
+            (adi, crashes) = daydata[anaday]
+            window = dict([(winday, daydata[winday]) for winday in
+                           [dayStringAdd(anaday, days=-offset) for offset in range(moving_average_days)]
+                           if winday in daydata])
+            store.put(ratesset, anaday, {
+                'adi': adi,
+                'rate': getRates(crashes, adi),
+                'rate' + str(moving_average_days) + 'd': sumDays(window)['rate'],
+            })
+
+        # Weekly and monthly sums of the periods the changed days are in.
+        weeks = set([getWeekStart(anaday) for anaday in changeddays])
+        months = set([getMonth(anaday) for anaday in changeddays])
+        perioddays = set([dayStringAdd(week, days=offset) for week in weeks for offset in range(7)])
+        for month in months:
+            anaday = month + '-01'
+            while getMonth(anaday) == month:
+                perioddays.add(anaday)
+                anaday = dayStringAdd(anaday, days=1)
+        daydata = loaddays(sorted(perioddays))
+        for week in weeks:
+            weekdata = dict([(anaday, data) for (anaday, data) in daydata.items()
+                             if getWeekStart(anaday) == week])
+            if weekdata:
+                store.put(weeklyset, week, sumDays(weekdata))
+        for month in months:
+            monthdata = dict([(anaday, data) for (anaday, data) in daydata.items()
+                              if getMonth(anaday) == month])
+            if monthdata:
+                store.put(monthlyset, month, sumDays(monthdata))
+        store.commit()
+
+    for rollupset in [ratesset, weeklyset, monthlyset]:
+        store.exportJSON(rollupset)